@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module contains the gcode file analysis for the 3D-Gui program.
+
+When a file is opened, an Analyzer thread indexes it (see jobfile) and
+then makes one streaming pass over it with the tokenizer, so the Tk main
+loop never blocks on a large file. The pass collects:
+    lines       number of lines
+    executable  number of lines holding a command
+    layers      one Layer (Z, source line, byte offset) per layer
+    bbox        (min X, Y, Z), (max X, Y, Z) of the extruding moves
+    extrusion   net filament length pushed: each retraction cancels
+                against the prime that follows it
+    tools       the tools selected by T commands
+    times       estimated print time at the end of each line (estimator)
+    checkpoints the modal state at the start of each chunk (resume)
+    arcs        the G2/G3 fitted into runs of G1 if asked for (arcfit)
+Then it compiles the job for printing (see jobcache), so Print only has
+to map the artifact. The thread posts ('progress', fraction), then
+('done', Jobfile, Analysis) or ('error', exception) to its queue, which
+the GUI polls.
+
+A layer starts at the line that last changed Z before the first move
+extruding above every earlier layer, so Z hops and travel moves do not
+count as layers. Arcs add their end points to the bounding box only.
+"""
+import queue
+import threading
+from collections import namedtuple
+
+import numpy as np
+
+import arcfit
+import estimator
+import jobcache
+import jobfile
+import resume
+import tokenizer
+
+Layer = namedtuple('Layer', 'z line offset')
+
+
+class Analysis():
+    ''' The result of analysing a gcode file.'''
+
+    def __init__(self):
+        self.lines = 0          # lines in the file
+        self.executable = 0     # lines holding a command
+        self.layers = []        # Layer per layer, bottom first
+        self.bbox = None        # ((min X, Y, Z), (max X, Y, Z)) extruded
+        self.extrusion = 0.0    # mm of filament
+        self.tools = ()         # tool numbers selected, ascending
+        self.toolChanges = 0    # T commands
+        self.times = None       # seconds at the end of each line, cumulative
+        self.checkpoints = []   # resume.Machine states, by line
+        self.arcs = None        # arcfit.Arcs, None if not fitted
+
+    def remaining(self, line):
+        ''' Estimated seconds from the end of source line line to the end.'''
+        if self.times is None or not len(self.times):
+            return None
+        return self.times[-1] - self.times[min(max(line, 0), len(self.times) - 1)]
+
+    def layerAt(self, line):
+        ''' Index of the layer source line line belongs to (-1: before
+            the first layer).
+        '''
+        index = -1
+        for i, layer in enumerate(self.layers):
+            if layer.line > line:
+                break
+            index = i
+        return index
+
+    def report(self):
+        ''' Text summary for a text panel.'''
+        lines = ['{} lines, {} executable, {} layers\n'
+                 .format(self.lines, self.executable, len(self.layers))]
+        if self.bbox:
+            lo, hi = self.bbox
+            lines.append('extent X {:.1f}..{:.1f} Y {:.1f}..{:.1f} Z {:.2f}..{:.2f} mm\n'
+                         .format(lo[0], hi[0], lo[1], hi[1], lo[2], hi[2]))
+        lines.append('filament {:.0f} mm'.format(self.extrusion))
+        if self.times is not None and len(self.times):
+            lines.append(', about {}'.format(duration(self.times[-1])))
+        if self.tools:
+            lines.append(', tools {} ({} changes)'.format(
+                ' '.join('T{}'.format(t) for t in self.tools), self.toolChanges))
+        lines.append('\n')
+        if self.arcs:
+            lines.append(self.arcs.report())
+        return ''.join(lines)
+
+
+def analyze(job, progress=None, chunk=1 << 20, arcTolerance=None):
+    ''' Analyse Jobfile job in one pass and return an Analysis. progress
+        is called with the fraction done after every chunk bytes. With
+        arcTolerance arcs are fitted as well.
+    '''
+    result = Analysis()
+    result.lines = len(job)
+    size = job.size()
+    pos = np.zeros(4)       # X Y Z E
+    top = -np.inf           # Z of the highest layer
+    zLine = 0               # where Z was last changed
+    lo = np.full(3, np.inf)
+    hi = np.full(3, -np.inf)
+    tools = set()
+    times = estimator.Estimator(len(job))
+    machine = resume.initial()
+    fitter = arcfit.Fitter(job, arcTolerance) if arcTolerance else None
+    for rows in tokenizer.parse(job, chunk):
+        if not len(rows):
+            continue
+        result.checkpoints.append(machine)
+        result.executable += len(rows)
+        start = pos.copy()
+        before = np.vstack((start, tokenizer.positions(rows, pos)))
+        prev, after = before[:-1], before[1:]
+        times.add(rows, prev, after)
+        if fitter:
+            fitter.add(rows, prev, after)
+        machine = resume.fold(machine, rows, pos, int(rows['line'][-1]) + 1)
+        move = (rows['cmd'] == b'G') & (rows['code'] >= 0) & (rows['code'] <= 3)
+        extruded = np.where(move, after[:, 3] - prev[:, 3], 0.)
+        extruding = extruded > 0
+        result.extrusion += extruded.sum()     # G92 rows are no moves
+        if extruding.any():
+            lo = np.minimum(lo, np.minimum(prev[extruding, :3], after[extruding, :3]).min(0))
+            hi = np.maximum(hi, np.maximum(prev[extruding, :3], after[extruding, :3]).max(0))
+
+        zChange = after[:, 2] != prev[:, 2]
+        latest = np.maximum.accumulate(np.where(zChange, np.arange(len(rows)), -1))
+        lines = np.where(latest >= 0, rows['line'][latest], zLine)
+        z = after[extruding, 2]
+        higher = z > np.maximum.accumulate(np.append(top, z))[:-1]
+        for layerZ, line in zip(z[higher].tolist(), lines[extruding][higher].tolist()):
+            result.layers.append(Layer(layerZ, line, job.offsets[line]))
+        if len(z):
+            top = max(top, z.max())
+        zLine = int(lines[-1])
+
+        toolRows = rows['code'][rows['cmd'] == b'T']
+        tools.update(toolRows.tolist())
+        result.toolChanges += len(toolRows)
+        if progress:
+            progress(job.offsets[rows['line'][-1] + 1] / size)
+    if np.isfinite(lo).all():
+        result.bbox = (tuple(lo.tolist()), tuple(hi.tolist()))
+    result.tools = tuple(sorted(tools))
+    result.times = times.times()
+    if fitter:
+        result.arcs = fitter.arcs
+    return result
+
+
+def duration(seconds):
+    ''' seconds as h:mm:ss.'''
+    minutes, seconds = divmod(int(seconds), 60)
+    return '{}:{:02d}:{:02d}'.format(minutes // 60, minutes % 60, seconds)
+
+
+class Analyzer(threading.Thread):
+    ''' Opens and analyses a gcode file in the background. Poll queue
+        from the Tk thread.
+    '''
+
+    def __init__(self, filename, arcTolerance=None):
+        threading.Thread.__init__(self, daemon=True)
+        self.filename = filename
+        self.arcTolerance = arcTolerance    # see analyze()
+        self.queue = queue.Queue()
+
+    def run(self):
+        job = None
+        report = lambda f: self.queue.put(('progress', f))
+        try:
+            # a compressed file is indexed in a pass of its own: half the work
+            job = jobfile.openJob(self.filename, lambda f: report(f / 2))
+            share = 0.5 if isinstance(job, jobfile.Streamfile) else 0.
+            result = analyze(job, lambda f: report(share + (1 - share) * f),
+                             arcTolerance=self.arcTolerance)
+            try:
+                jobcache.load(job, arcs=result.arcs).close()
+            except OSError:     # cache not writable: compile on Print
+                pass
+            self.queue.put(('done', job, result))
+        except Exception as e:
+            if job:
+                job.close()
+            self.queue.put(('error', e))
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module contains the arc fitting pre-pass for the 3D-Gui program.
+
+Slicers write curved perimeters as runs of short G1 segments, each of
+which costs a round trip over the serial link and a planner slot. The
+fitter finds runs of at least MINSEGMENTS segments whose vertices and
+segment midpoints all lie within tolerance of one circle and replaces
+each run by a single G2/G3. It runs on the tokenized job during the
+background analysis (see analysis), chunk by chunk:
+  - segmentation: consecutive G1 moves in the XY plane (absolute XY,
+    no Z change, no other parameters, F changing only on the first)
+    are linked when they turn the same way by less than MAXTURN, their
+    lengths differ by less than a factor of LENGTHRATIO and they extrude
+    at the same rate within EXTRUSION (or are both travel moves)
+  - verification: each run is checked against the circle through its
+    first, middle and last point; a run that deviates is split at its
+    worst segment, a closed one in the middle, and the halves are
+    checked again, all runs of a chunk at once, so the work is a few
+    NumPy operations per round
+The arc carries the E of the run: the same amount of filament, laid
+down evenly along the arc, whose length differs from the segments' by
+less than the tolerance allows. Runs do not cross chunk boundaries.
+The arcs are applied when the job is compiled (see jobcache), which
+needs ARC_SUPPORT in Marlin (enabled by default).
+"""
+import numpy as np
+
+import tokenizer
+
+TOLERANCE = 0.025       # mm the arc may deviate from the segments
+MINSEGMENTS = 3         # segments an arc replaces at least
+MAXTURN = 0.5           # rad between segments; sharper turns are corners
+LENGTHRATIO = 4.        # segment length ratio between neighbours
+MAXRADIUS = 1000.       # mm; flatter curves stay straight lines
+EXTRUSION = 0.05        # relative deviation of E per mm within an arc
+ROUNDS = 32             # splits of a run at most
+
+
+def _number(value, digits):
+    ''' value with digits decimals, trailing zeros removed.'''
+    return '{:.{}f}'.format(value, digits).rstrip('0').rstrip('.')
+
+
+class Arcs():
+    ''' The arcs fitted into a job.'''
+
+    def __init__(self, tolerance):
+        self.tolerance = tolerance
+        self.runs = {}          # first source line: (last source line, command)
+        self.lines = 0          # source lines replaced
+        self.bytes = 0          # bytes of those lines
+        self.arcBytes = 0       # bytes of the arc commands
+        self.jobLines = 0       # lines and bytes of the whole job
+        self.jobBytes = 0
+
+    def key(self):
+        ''' Tells artifacts compiled with different arcs apart (see jobcache).'''
+        return 'arc{:g}'.format(self.tolerance)
+
+    def report(self):
+        ''' Text summary for a text panel.'''
+        if not self.runs:
+            return 'arc fitting: no arcs found\n'
+        saved = self.lines - len(self.runs)
+        savedBytes = self.bytes - self.arcBytes
+        return ('arc fitting: {} lines into {} arcs, {} lines ({:.1f}%), '
+                '{:.0f} kB ({:.1f}%) less\n'
+                .format(self.lines, len(self.runs), saved,
+                        100 * saved / max(self.jobLines, 1), savedBytes / 1000,
+                        100 * savedBytes / max(self.jobBytes, 1)))
+
+
+class Fitter():
+    ''' Arc fitting of one job, fed chunk by chunk.'''
+
+    def __init__(self, job, tolerance=TOLERANCE):
+        self.job = job          # Jobfile, for the sizes of the lines
+        self.arcs = Arcs(tolerance)
+        self.arcs.jobLines, self.arcs.jobBytes = len(job), job.size()
+
+    def add(self, rows, prev, after):
+        ''' Fit the rows of a chunk; prev and after are the positions
+            before and after each row (see tokenizer.positions).
+        '''
+        if len(rows) < MINSEGMENTS:
+            return
+        delta = after - prev
+        length = np.hypot(delta[:, 0], delta[:, 1])
+        first, last = self._segment(rows, delta, length)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rate = np.where(length > 0, delta[:, 3] / length, 0.)
+            for _ in range(ROUNDS):
+                keep = last - first + 1 >= MINSEGMENTS
+                first, last = first[keep], last[keep]
+                if not len(first):
+                    break
+                fits, split, centre = self._verify(first, last, prev, after, length, rate)
+                for k, m, c in zip(first[fits].tolist(), last[fits].tolist(), centre[fits]):
+                    self._arc(rows, prev, after, k, m, c)
+                drop = np.isnan(split)
+                first, last, split = first[~fits & ~drop], last[~fits & ~drop], split[~fits & ~drop]
+                split = np.clip(split.astype(np.int64), first, last - 1)
+                first, last = np.concatenate((first, split + 1)), np.concatenate((split, last))
+
+    def _segment(self, rows, delta, length):
+        ''' First and last row of each candidate run.'''
+        cmd, code = rows['cmd'], rows['code']
+        other = np.zeros(len(rows), bool)
+        for p in 'STPIJR':
+            other |= ~np.isnan(rows[p])
+        extruding = delta[:, 3] > 0
+        candidate = ((cmd == b'G') & (code == 1) & rows['absolute'] & ~other
+                     & (delta[:, 2] == 0) & (delta[:, 3] >= 0) & (length > 0))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rate = np.where(length > 0, delta[:, 3] / length, 0.)
+            turn = np.arctan2(delta[:-1, 0] * delta[1:, 1] - delta[:-1, 1] * delta[1:, 0],
+                              delta[:-1, 0] * delta[1:, 0] + delta[:-1, 1] * delta[1:, 1])
+            ratio = length[1:] / length[:-1]
+        feed = rows['F']
+        known = np.maximum.accumulate(np.where(np.isnan(feed), -1, np.arange(len(rows))))
+        feed = np.where(np.isnan(feed), feed[np.maximum(known, 0)], feed)   # as set before
+        # link[j]: rows j and j + 1 belong to the same run
+        link = (candidate[:-1] & candidate[1:]
+                & (np.isnan(rows['F'][1:]) | (rows['F'][1:] == feed[:-1]))
+                & (extruding[:-1] == extruding[1:])
+                & (np.abs(turn) <= MAXTURN) & (turn != 0)
+                & (ratio <= LENGTHRATIO) & (ratio >= 1 / LENGTHRATIO)
+                & (np.abs(rate[1:] - rate[:-1])
+                   <= EXTRUSION * np.maximum(rate[1:], rate[:-1])))
+        link[1:] &= ~(link[:-1] & (np.sign(turn[1:]) != np.sign(turn[:-1])))
+        before = np.concatenate(([False], link))
+        after = np.concatenate((link, [False]))
+        return (np.flatnonzero(candidate & ~before & after),
+                np.flatnonzero(candidate & before & ~after))
+
+    def _verify(self, first, last, prev, after, length, rate):
+        ''' Check the runs first..last against the circle through their
+            first, middle and last point. Returns the mask of the runs
+            that fit, the segment to split each other run after (NaN:
+            drop the run) and the centres.
+        '''
+        tolerance = self.arcs.tolerance
+        a = prev[first, :2]
+        b = after[(first + last - 1) // 2, :2]
+        c = after[last, :2]
+        d = 2 * (a[:, 0] * (b[:, 1] - c[:, 1]) + b[:, 0] * (c[:, 1] - a[:, 1])
+                 + c[:, 0] * (a[:, 1] - b[:, 1]))
+        aa, bb, cc = (a ** 2).sum(1), (b ** 2).sum(1), (c ** 2).sum(1)
+        centre = np.stack(((aa * (b[:, 1] - c[:, 1]) + bb * (c[:, 1] - a[:, 1])
+                            + cc * (a[:, 1] - b[:, 1])) / d,
+                           (aa * (c[:, 0] - b[:, 0]) + bb * (a[:, 0] - c[:, 0])
+                            + cc * (b[:, 0] - a[:, 0])) / d), 1)
+        radius = np.hypot(*(a - centre).T)
+        ccw = np.sign(d)        # d > 0: counter clockwise
+
+        # every segment of every run:
+        counts = last - first + 1
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        run = np.repeat(np.arange(len(first)), counts)
+        seg = np.arange(counts.sum()) - starts[run] + first[run]
+        o = centre[run]
+        r = radius[run]
+        p0, p1 = prev[seg, :2] - o, after[seg, :2] - o
+        middle = (p0 + p1) / 2
+        deviation = np.maximum(np.abs(np.hypot(*p1.T) - r), np.abs(np.hypot(*middle.T) - r))
+        score = deviation / tolerance
+        score[np.sign(p0[:, 0] * p1[:, 1] - p0[:, 1] * p1[:, 0]) != ccw[run]] = np.inf
+        mean = (np.add.reduceat((after[seg, 3] - prev[seg, 3]), starts)
+                / np.add.reduceat(length[seg], starts))
+        score = np.maximum(score, np.abs(rate[seg] - mean[run])
+                           / np.maximum(mean[run], 1e-12) / EXTRUSION)
+        score = np.nan_to_num(score, nan=np.inf)
+
+        worst = np.maximum.reduceat(score, starts)
+        split = np.minimum.reduceat(np.where(score == worst[run], seg, np.iinfo(np.int64).max),
+                                    starts).astype(float)
+        sweep = np.add.reduceat(2 * np.arcsin(np.clip(length[seg] / (2 * r), 0, 1)), starts)
+        split[~(radius <= MAXRADIUS)] = np.nan  # flat or degenerate
+        # a closed loop or one too close to a full circle: halve it
+        halve = (sweep >= 2 * np.pi - 0.1) | (np.hypot(*(c - a).T) <= tolerance)
+        split[halve] = ((first + last - 1) // 2)[halve]
+        fits = (worst <= 1) & ~halve & (radius <= MAXRADIUS)
+        return fits, split, centre
+
+    def _arc(self, rows, prev, after, k, m, centre):
+        ''' Record the arc replacing rows k..m.'''
+        start, end = prev[k], after[m]
+        a, b = prev[k, :2], after[(k + m - 1) // 2, :2]
+        turn = (b[0] - a[0]) * (end[1] - b[1]) - (b[1] - a[1]) * (end[0] - b[0])
+        words = ['G3' if turn > 0 else 'G2',
+                 'X' + _number(end[0], 3), 'Y' + _number(end[1], 3),
+                 'I' + _number(centre[0] - start[0], 3), 'J' + _number(centre[1] - start[1], 3)]
+        if end[3] != start[3]:
+            words.append('E' + _number(end[3] - start[3] if rows['relE'][m] else end[3], 5))
+        if not np.isnan(rows['F'][k]):
+            words.append('F' + _number(rows['F'][k], 3))
+        command = ' '.join(words).encode('ascii')
+        line, lastLine = int(rows['line'][k]), int(rows['line'][m])
+        arcs = self.arcs
+        arcs.runs[line] = (lastLine, command)
+        arcs.lines += lastLine - line + 1
+        arcs.bytes += self.job.offsets[lastLine + 1] - self.job.offsets[line]
+        arcs.arcBytes += len(command) + 1
+
+
+def fit(job, tolerance=TOLERANCE):
+    ''' The Arcs fitted into Jobfile job.'''
+    fitter = Fitter(job, tolerance)
+    pos = np.zeros(4)
+    for rows in tokenizer.parse(job):
+        start = pos.copy()
+        before = np.vstack((start, tokenizer.positions(rows, pos)))
+        fitter.add(rows, before[:-1], before[1:])
+    return fitter.arcs
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This is the asyncio transport module for the 3D-Gui program.
+
+AsyncTransport is an alternative to the thread based Transport. Instead
+of the listen, sender and print threads plus the decoder thread of the
+data module it runs a reader coroutine, a writer coroutine and the
+decoding of incoming messages on a single asyncio event loop in one
+background thread. The writer waits for free buffers in Marlin on an
+event set by the reader, so the two never race for the flow control
+state. Framing, flow control, resend handling and job bookkeeping are
+inherited from Transport.
+
+The gui drives it through the same connect / disconnect / start_print /
+abort_print calls; these hand the work over to the event loop and wait
+for its result. While connected data.xmtQ is replaced by a bridge that
+forwards commands to the loop.
+"""
+import asyncio
+import os
+import threading
+
+import data
+from transport import Transport
+
+
+class CommandBridge():
+    ''' Replaces data.xmtQ while AsyncTransport is connected: commands
+        put by the gui are handed to the event loop thread-safely.
+    '''
+
+    def __init__(self, transport):
+        self.transport = transport
+
+    def put(self, command):
+        self.transport.loop.call_soon_threadsafe(
+            self.transport.commands.put_nowait, command)
+
+
+class AsyncTransport(Transport):
+
+    def __init__(self, status=None):
+        Transport.__init__(self, status)
+        self.loop = None        # event loop doing all the printer I/O
+        self.loopThread = None  # thread running the loop
+        self.started = threading.Event()   # loop is up and running
+        self.commands = None    # asyncio.Queue: commands when not printing
+        self.room = None        # asyncio.Event: flow control state changed
+        self.stopped = None     # asyncio.Event: set to shut the loop down
+        self.xmtQ = None        # data.xmtQ while the bridge replaces it
+
+    #--------------------------------------------------------------------------
+    # gui side (Tk thread)
+    #--------------------------------------------------------------------------
+
+    def connect(self, status=None):
+        ''' Open the port and start the event loop thread. Decoding is
+            done on the loop, so the decoder thread is stopped.
+        '''
+        if not self._open(status):
+            return False
+        data.stop_decoder()
+        self.loop = asyncio.new_event_loop()
+        self.started.clear()
+        self.loopThread = threading.Thread(target = self._run,
+                                           name = "transport_loop")
+        self.loopThread.start()
+        self.started.wait()
+        self.xmtQ, data.xmtQ = data.xmtQ, CommandBridge(self)
+        return True
+
+    def disconnect(self, status=None):
+        ''' Stop the event loop, close the port, clear status vars.'''
+        if self.loop:
+            self.printing = False
+            self.loop.call_soon_threadsafe(self._shutdown)
+            self.loopThread.join()
+            self.loopThread = None
+            self.loop = None
+            data.xmtQ = self.xmtQ
+        self._close(status)
+
+    def start_print(self, line = 0, prologue = ()):
+        ''' Load the job and let the writer coroutine print it, from
+            source line line after the commands prologue (see resume).
+        '''
+        if not self.loop or not self._loadJob():
+            return False
+        first = self._firstFrame(line)
+        if first is None:
+            return False
+        return self._call(self._startPrint(first, prologue))
+
+    def abort_print(self):
+        print("Entering abort_print")
+        if self.loop:
+            self._call(self._abortPrint())
+        else:
+            self.printing = False
+            self._closeJob()
+
+    def _call(self, coro):
+        ''' Run coro on the event loop and wait for its result.'''
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    #--------------------------------------------------------------------------
+    # event loop side
+    #--------------------------------------------------------------------------
+
+    def _run(self):
+        ''' Body of the loop thread.'''
+        print("Starting transport loop")
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self._main())
+        self.loop.close()
+        print("Transport loop stopped")
+
+    async def _main(self):
+        self.commands = asyncio.Queue()
+        self.room = asyncio.Event()
+        self.stopped = asyncio.Event()
+        del self.rxBuf[:]
+        tasks = [asyncio.ensure_future(self._reader()),
+                 asyncio.ensure_future(self._writer())]
+        self.started.set()
+        await self.stopped.wait()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions = True)
+
+    def _shutdown(self):
+        self.stopped.set()
+        self.room.set()
+
+    async def _reader(self):
+        ''' Reader coroutine: read whatever the printer sends as soon as
+            the port becomes readable and dispatch it line by line.
+        '''
+        fd = self.printer.fileno()
+        readable = asyncio.Event()
+        self.loop.add_reader(fd, readable.set)
+        try:
+            while True:
+                await readable.wait()
+                readable.clear()
+                try:
+                    chunk = os.read(fd, 4096)
+                except BlockingIOError:
+                    continue
+                except OSError as e:
+                    self.status.show("*** Error: Can't read from printer\n")
+                    print("Reader:", e)
+                    self.printing = False
+                    break
+                self._receive(chunk)
+        finally:
+            self.loop.remove_reader(fd)
+
+    async def _writer(self):
+        ''' Writer coroutine: sends the job while printing and commands
+            from the gui otherwise. Commands arriving during a print wait
+            in the queue until the print is over.
+        '''
+        while True:
+            if self.printing and self.job:
+                await self._sendNext()
+                continue
+            command = await self.commands.get()
+            if command is None:     # wake up call
+                continue
+            await self._awrite(self._frame(command), 0,
+                              lambda: self.stopped.is_set())
+
+    async def _sendNext(self):
+        ''' Coroutine version of Transport.sendNext().'''
+        item = self._takeFrame()
+        if item:
+            size = len(item[0])
+            await self._until(lambda: self._canSend(size) or not self.printing)
+            with self.flow:
+                if not self.printing:
+                    return
+                frames = self._batch(item)
+            self._transmit(frames)
+        elif item is None:  # all sent
+            try:
+                await asyncio.wait_for(self._until(self._drained), 5.0)
+            except asyncio.TimeoutError:
+                pass
+            with self.flow:
+                done = self.printing and self.resendFrom == -1
+            if done:    # not aborted while draining
+                self._complete()
+
+    async def _startPrint(self, first, prologue):
+        lineno = first - len(prologue) - 1
+        if not await self._awrite(self._frame("M110", lineno, True), lineno,
+                                 lambda: self.stopped.is_set()):
+            self._closeJob()
+            return False
+        self._resetPrint(first, prologue)
+        self.printing = True
+        self.commands.put_nowait(None)  # wake up the writer
+        return True
+
+    async def _abortPrint(self):
+        self.printing = False
+        self.room.set()     # release the writer if it waits for buffers
+        self._closeJob()
+
+    async def _until(self, predicate):
+        ''' Wait until predicate() (evaluated with flow held) is True.'''
+        while True:
+            with self.flow:
+                if predicate():
+                    return
+                self.room.clear()
+            await self.room.wait()
+
+    async def _awrite(self, frame, lineno = 0, cancelled = None):
+        ''' Coroutine version of Transport._write(): wait for room in
+            Marlin's buffers, then transmit the frame.
+        '''
+        if cancelled is None:
+            cancelled = lambda: not self.printing
+        size = len(frame)
+        await self._until(lambda: self._canSend(size) or cancelled())
+        with self.flow:
+            if cancelled():
+                return False    # aborted while waiting for buffers
+            self._commit(size, lineno)
+        return self._transmit(frame)
+
+    def _notify(self):
+        ''' Flow control state changed: wake up the writer.'''
+        self.room.set()
+
+    def _deliver(self, line):
+        ''' Decode messages right away instead of queueing them.'''
+        data.decode(line)
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Throughput and latency benchmark for the transport of the 3D-Gui program.
+
+Every run prints a synthetic job end-to-end through start_print() to the
+simulated printer of marlinsim.py. The simulator runs in a subprocess,
+so the CPU time and memory reported are the host's alone, and each run
+in a fresh interpreter of its own, so its peak RSS is not that of an
+earlier, larger run. Job shapes:
+    dense       short G1 segments, as sliced curves and tiny arcs
+    long        long moves carrying all axes and a feedrate
+    comments    mostly comment lines, as written by verbose slicers
+    huge        dense segments, 20 times the number of lines
+Reported per run: lines/s, bytes/s, writes to the port and lines per
+write, send-to-ok latency percentiles, host CPU per 1000 lines, peak RSS
+and resend recovery time. --single writes every line on its own, as
+before frames were coalesced, for comparison. Results can
+be saved as JSON to compare transport changes over time:
+    python3 benchmark.py --shape all --json results/$(git rev-parse --short HEAD).json
+    python3 benchmark.py --shape dense --latency 0.002 --flow chars --errors 500
+With --decoder the decode stage is timed instead, on printer output
+recorded in testdata/marlin.log, against the regex table it replaced:
+    python3 benchmark.py --decoder
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import re
+import resource
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import data
+import jobcache
+import jobfile
+import transport as tr
+import asynctransport as atr
+
+SHAPES = {
+    'dense': lambda i: 'G1 X{:.3f} Y{:.3f} E{:.5f}\n'.format(
+                       i % 200 * 0.1, i % 150 * 0.1, i * 0.0021),
+    'long': lambda i: 'G1 X{:.3f} Y{:.3f} Z{:.2f} E{:.5f} F{}\n'.format(
+                      (i * 37) % 200 + 0.123, (i * 53) % 200 + 0.456,
+                      0.2 + i // 1000 * 0.2, i * 1.3, 3000 + i % 5 * 600),
+    'comments': lambda i: 'G1 X{:.3f} Y{:.3f} E{:.5f}\n'.format(
+                          i % 200 * 0.1, i % 150 * 0.1, i * 0.0021) if i % 5 == 0
+                          else '; perimeter {} of island {}: outer wall, speed 45 mm/s\n'
+                          .format(i % 7, i // 50),
+    }
+SHAPES['huge'] = SHAPES['dense']
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+class Console():
+    ''' Text panel stand-in.'''
+
+    def __init__(self, verbose=False):
+        self.verbose = verbose
+
+    def show(self, txt):
+        if self.verbose:
+            print(txt, end='')
+
+
+class Simulator():
+    ''' marlinsim.py running in a subprocess.'''
+
+    def __init__(self, *args):
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'marlinsim.py')
+        self.process = subprocess.Popen([sys.executable, script] + list(args),
+                                        stdout=subprocess.PIPE, text=True)
+        self.port = self.process.stdout.readline().split()[-1]
+
+    def stop(self):
+        ''' Stop the simulator and return its statistics.'''
+        self.process.send_signal(signal.SIGINT)
+        stats = self.process.stdout.read().strip().splitlines()
+        self.process.wait()
+        return json.loads(stats[-1]) if stats else {}
+
+
+def makeJob(shape, lines):
+    ''' Write a job of the given shape and return its filename.'''
+    fd, name = tempfile.mkstemp(suffix='.gcode')
+    line = SHAPES[shape]
+    with os.fdopen(fd, 'w') as f:
+        f.writelines(line(i) for i in range(lines))
+    return name
+
+
+def isolated(cacheDir, *args):
+    ''' run() in a fresh interpreter, so peak RSS (a high-water mark of
+        the whole process) is that of this run alone.
+    '''
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(_child, (cacheDir,) + args)
+
+
+def _child(cacheDir, *args):
+    jobcache.cacheDir = cacheDir
+    return run(*args)
+
+
+def run(shape='dense', lines=20000, engine='threads', flow='ok',
+        moveTime=0.0, bufsize=4, latency=0.0, errors=0, coalesce=True):
+    ''' Print one synthetic job and return the measurements.'''
+    data.flowControl = flow
+    data.metrics = True
+    data.state.reset()
+    data.port, data.baud = None, 250000
+    errorLines = ','.join(str(n) for n in range(errors, lines, errors)) if errors else ''
+    sim = Simulator('--move-time', str(moveTime), '--bufsize', str(bufsize),
+                    '--latency', str(latency),
+                    *(['--errors', errorLines] if errorLines else []))
+    data.port = sim.port
+    name = makeJob(shape, lines)
+    data.gcodeFile = jobfile.Jobfile(name)
+    data.filesize = len(data.gcodeFile)
+    data.init(Console(), Console())
+
+    transport = (atr.AsyncTransport if engine == 'asyncio'
+                 else tr.Transport)(status=Console())
+    transport.coalesce = coalesce
+    transport.connect(status=Console())
+    deadline = time.monotonic() + 5
+    while not data.state.get().ready and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    compile = time.perf_counter()
+    jobcache.load(data.gcodeFile).close()
+    compile = time.perf_counter() - compile
+
+    cpu, wall = time.process_time(), time.perf_counter()
+    started = transport.start_print()
+    while transport.printing:
+        time.sleep(0.01)
+    cpu, wall = time.process_time() - cpu, time.perf_counter() - wall
+
+    transport.disconnect(status=Console())
+    data.stop_decoder()
+    stats = sim.stop()
+    data.gcodeFile.close()
+    os.remove(name)
+    frames = len(transport.job) if transport.job else transport.maxIndex
+    metrics = transport.metrics
+    recovery = [1000 * r['duration'] for r in transport.resendLog]
+    result = {'shape': shape, 'engine': engine, 'flow': flow,
+              'lines': lines, 'frames': frames, 'started': started,
+              'compile s': compile,
+              'seconds': wall,
+              'lines/s': frames / wall,
+              'bytes/s': metrics.counters['bytes'] / wall,
+              'writes': metrics.counters['writes'],
+              'lines/write': metrics.counters['frames'] / metrics.counters['writes']
+                             if metrics.counters['writes'] else 0,
+              'cpu s': cpu,
+              'cpu ms/1k lines': 1000 * cpu / frames * 1000 if frames else 0,
+              'peak rss MB': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+              'overflows': stats.get('overflows', 0),
+              'underruns': len(transport.underruns.events),
+              'resends': len(transport.resendLog),
+              'resent lines': sum(r['lines'] for r in transport.resendLog),
+              'recovery ms max': max(recovery, default=0),
+              'recovery ms mean': sum(recovery) / len(recovery) if recovery else 0}
+    for p in PERCENTILES:
+        result['latency ms p{:g}'.format(p)] = metrics.latency.percentile(p) / 1000
+    return result
+
+
+# the decoder before it dispatched on prefixes, for comparison:
+legacyPos = [0., 0., 0., 0.]
+legacyTmp = {key: {'PV': -1, 'SP': -1} for key in ('T0:', 'T1:', 'B:')}
+
+def legacyPositions(m):
+    for i, n in enumerate(m):
+        legacyPos[i] = float(n)
+
+def legacyTemperatures(m):
+    for grp in m[1::]:
+        legacyTmp[grp[0]]['PV'] = float(grp[1])
+        legacyTmp[grp[0]]['SP'] = float(grp[2])
+
+def legacyWarmup(m):
+    legacyTmp['T'+tuple(*m)[1]+':']['PV'] = float(tuple(*m)[0])
+
+def legacyBed(m):
+    legacyTmp['B:']['PV'] = float(tuple(*m)[2])
+
+legacyTable = [(re.compile(r"[XYZE]:(-?\d+\.\d+)"), legacyPositions),
+               (re.compile(r'([BT][01]?:)([+-]?\d*?\.\d*?)\s*?\/(\d*\.\d*)'),
+                legacyTemperatures),
+               (re.compile(r"(echo:\s*M217).*"), data.setReadyFlag),
+               (re.compile(r"(echo:\s*SD\sinit).*"), data.setReadyFlag),
+               (re.compile(r"Active\s+Extruder:\s*([01])"), lambda m: None),
+               (re.compile(r'^T:(\d*\.\d*)\s*E:(\d*)\s*(W:[?0-9]{1,2}$)$'),
+                legacyWarmup),
+               (re.compile(r'^T:(\d*\.\d*)\s*E:(\d*)\s*B:(\d*\.\d*)$'),
+                legacyBed)]
+
+
+def legacyDecode(line):
+    for regex, function in legacyTable:
+        match = re.findall(regex, line)
+        if match:
+            function(match)
+            return
+    data.info.show(line)
+
+
+def decoderBench(filename, seconds=2.0):
+    ''' Time data.decode against legacyDecode on the lines of a log
+        the transport would hand to the decoder.
+    '''
+    with open(filename) as f:
+        lines = [line for line in f
+                 if not line.startswith('ok') or 'T0:' in line]
+    data.info = data.status = Console()
+    result = {'log lines': len(lines)}
+    for name, decode in (('legacy', legacyDecode), ('decode', data.decode)):
+        n, start = 0, time.perf_counter()
+        while time.perf_counter() - start < seconds:
+            for line in lines:
+                decode(line)
+            n += len(lines)
+        result[name + ' lines/s'] = n / (time.perf_counter() - start)
+    result['speedup'] = result['decode lines/s'] / result['legacy lines/s']
+    return result
+
+
+def revision():
+    ''' Short hash of the checked out revision, if any.'''
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                    cwd=os.path.dirname(os.path.abspath(__file__)),
+                    stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                             formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--shape', choices=sorted(SHAPES) + ['all'], default='dense',
+                        help='job shape to print')
+    parser.add_argument('--lines', type=int, default=20000,
+                        help='number of lines in the job (huge: 20 times)')
+    parser.add_argument('--engine', choices=('threads', 'asyncio'), default='threads',
+                        help='transport engine')
+    parser.add_argument('--flow', choices=('ok', 'chars'), default='ok',
+                        help='flow control mode of the transport')
+    parser.add_argument('--move-time', type=float, default=0.0,
+                        help='execution time per move in seconds')
+    parser.add_argument('--bufsize', type=int, default=4,
+                        help="Marlin's BUFSIZE (command queue slots)")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='round trip time of the serial link in seconds')
+    parser.add_argument('--errors', type=int, default=0,
+                        help='make every ERRORS-th line fail its checksum')
+    parser.add_argument('--single', action='store_true',
+                        help='write every line on its own')
+    parser.add_argument('--json', metavar='FILE',
+                        help='save the results to FILE')
+    parser.add_argument('--decoder', nargs='?', metavar='LOG',
+                        const=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                           'testdata', 'marlin.log'),
+                        help='benchmark the decoder on a printer log instead')
+    args = parser.parse_args()
+    if args.decoder:
+        for key, value in decoderBench(args.decoder).items():
+            print('  {:>18}: {:.2f}'.format(key, value))
+        return
+
+    jobcache.cacheDir = tempfile.mkdtemp()
+    results = []
+    try:
+        for shape in sorted(SHAPES) if args.shape == 'all' else [args.shape]:
+            results.append(isolated(jobcache.cacheDir, shape,
+                                    args.lines * (20 if shape == 'huge' else 1),
+                                    args.engine, args.flow, args.move_time,
+                                    args.bufsize, args.latency, args.errors,
+                                    not args.single))
+            print('{}:'.format(shape))
+            for key, value in results[-1].items():
+                if isinstance(value, float):
+                    value = '{:.2f}'.format(value)
+                print('  {:>18}: {}'.format(key, value))
+    finally:
+        shutil.rmtree(jobcache.cacheDir)
+    if args.json:
+        settings = vars(args).copy()
+        del settings['json']
+        with open(args.json, 'w') as f:
+            json.dump({'revision': revision(),
+                       'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'settings': settings,
+                       'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module contains the temperature chart panel for the 3D-Gui program.
+
+The chart plots the PV and SP history of both hotends and the bed from
+the telemetry store (data.history). It is drawn incrementally: each
+refresh queries only the rows recorded since the last one, averages them
+per pixel column and appends one line item per channel. Scrolling moves
+the canvas' scroll region instead of the items, and the items that left
+the view are deleted, so the Tk work per refresh stays the same however
+long the history gets.
+"""
+import time
+import tkinter as tk
+from tkinter import ttk
+
+import numpy as np
+
+class Chartpanel(ttk.Frame):
+    ''' A strip chart of the heater temperatures.'''
+
+    # channel, color, dash pattern:
+    series = (('T0 PV', 'orange', ()), ('T0 SP', 'orange', (2, 4)),
+              ('T1 PV', 'yellow', ()), ('T1 SP', 'yellow', (2, 4)),
+              ('B PV', 'cyan', ()), ('B SP', 'cyan', (2, 4)))
+
+    def __init__(self, master, history, caption=' Temperatures', w=700, h=120,
+                 span=900, scale=300, interval=1000):
+        ttk.Frame.__init__(self, master)
+        self.master = master
+        self.history = history  # telemetry.Telemetry to plot
+        self.w, self.h = w, h   # canvas size in pixels
+        self.span = span        # seconds shown
+        self.scale = scale      # temperature at the top of the chart
+        self.interval = interval    # ms between refreshes
+        self.pps = w / span     # pixels per second
+        self.origin = time.time()   # time at x = 0
+        self.last = None        # time of the last row drawn
+        self.tail = {}          # channel: last point drawn (x, y)
+        self.items = []         # (right edge x, item) of the line items, oldest first
+
+        self.label = ttk.Label(self, text='{} (0-{} ⁰C, last {} min)'
+                               .format(caption, scale, span // 60))
+        self.cv = tk.Canvas(self, width=w, height=h, bd=1, highlightt=0,
+                            bg='black', xscrollincrement=1)
+        self.label.grid(row=0, column=0, padx=4, pady=4, sticky='W')
+        self.cv.grid(row=1, column=0, padx=4, pady=4)
+        self.rules = []         # (line, text) per grid temperature
+        for temp in range(50, scale, 50):
+            y = self._y(temp)
+            self.rules.append((self.cv.create_line(0, y, w, y, fill='gray25'),
+                              self.cv.create_text(2, y, text=temp, anchor='sw',
+                                                  fill='gray50', font=('Helvetica', 7))))
+        self.after(self.interval, self.refresh)
+
+    def _y(self, temp):
+        return self.h - temp * self.h / self.scale
+
+    def refresh(self):
+        ''' Draw what was recorded since the last refresh and scroll.'''
+        now = time.time()
+        start = now - self.span if self.last is None else self.last
+        times, values = self.history.query(start, None, [s[0] for s in self.series])
+        if self.last is not None:   # the row at start has been drawn already
+            keep = times > self.last
+            times, values = times[keep], values[keep]
+        if len(times):
+            self._append(times, values)
+            self.last = times[-1]
+        right = (now - self.origin) * self.pps
+        self.cv.configure(scrollregion=(right - self.w, 0, right, self.h))
+        self.cv.xview_moveto(0)
+        for line, text in self.rules:    # keep the grid in view
+            y = self.cv.coords(line)[1]
+            self.cv.coords(line, right - self.w, y, right, y)
+            self.cv.coords(text, right - self.w + 2, y)
+        left = right - self.w
+        old = 0
+        while old < len(self.items) and self.items[old][0] < left:
+            self.cv.delete(self.items[old][1])
+            old += 1
+        del self.items[:old]
+        self.after(self.interval, self.refresh)
+
+    def _append(self, times, values):
+        ''' Average the rows per pixel column and extend the lines.'''
+        columns = np.floor((times - self.origin) * self.pps)
+        starts = np.flatnonzero(np.diff(columns, prepend=np.nan))
+        counts = np.diff(np.append(starts, len(columns)))
+        xs = columns[starts]
+        valid = np.minimum.reduceat(values, starts, axis=0) >= 0    # -1: unknown
+        ys = self._y(np.add.reduceat(values, starts, axis=0) / counts[:, None])
+        for k, (channel, color, dash) in enumerate(self.series):
+            runs = []   # runs of valid points
+            run = [self.tail[channel]] if channel in self.tail else []
+            for x, y, ok in zip(xs.tolist(), ys[:, k].tolist(), valid[:, k].tolist()):
+                if ok:
+                    run.append((x, y))
+                elif run:
+                    runs.append(run)
+                    run = []
+            if run:
+                runs.append(run)
+            if valid[-1, k]:
+                self.tail[channel] = run[-1]
+            else:
+                self.tail.pop(channel, None)
+            for run in runs:
+                if len(run) > 1:
+                    item = self.cv.create_line(*[c for p in run for c in p],
+                                               fill=color, dash=dash, width=1)
+                    self.items.append((run[-1][0], item))
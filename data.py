@@ -6,7 +6,9 @@ Created on Sat Aug 27 12:49:51 2022
 @author: hschulz
 This module contains all gobal vars for the 3D-Gui program
 """
-import queue, re, threading
+import queue, re, threading, time
+from state import StateStore
+from telemetry import Telemetry
 
 # global data:
 port = None             # serial port name
@@ -14,9 +16,16 @@ baud = None             # serial baud rate
 connected = None        # true if link to printer established
 gcodeFile = None        # handle to open gcode file
 fileSize = 0            # numlines in gcode
-ready = False           # printer reported ready
-homed = set()           # axes that have been homed
+analysis = None         # analysis.Analysis of gcodeFile
 selectedAxis = None     # current axis to jog
+flowControl = 'ok'      # 'ok': count lines, 'chars': count RX buffer bytes
+engine = 'threads'      # transport: 'threads' or 'asyncio'
+metrics = False         # collect transport metrics (see metrics.py)
+arcTolerance = None     # mm: fit G1 runs into G2/G3 on file open (see arcfit.py), None: off
+refreshInterval = 0.5   # seconds between gui refreshes
+state = StateStore()    # printer state: positions, temperatures, ready, ..
+history = Telemetry()   # time series of temperatures and positions
+recordInterval = 0.5    # seconds between rows recorded in history at least
 
 #------------------------------------------------------------------------------    
 # decoder stuff
@@ -33,88 +42,118 @@ rcvQ = None    # data from printer to gui
 info = None
 status = None
 
-# gui data:
-pos = [0., 0., 0., 0., None, None, None]  # X, Y, Z, E reported positions
-tmp = {
-      'T0:': {'PV': -1, 'SP': -1},
-      'T1:': {'PV': -1, 'SP': -1},
-      'B:':  {'PV': -1, 'SP': -1}}
-
-def setPositions(m):
-    ''' Update positions data for reported axes. '''
-    global pos
-    for i, n in enumerate(m): # all but extruder pos
-        pos[i] = float(n)
-
-def setTemperatures(m):
-    ''' Update all reprted temperature data. '''
-    global tmp
-    try:
-        for grp in m[1::]:  # first group is redundant: skip
-            tmp[grp[0]]['PV'] = float(grp[1])
-            tmp[grp[0]]['SP'] = float(grp[2])
-    except Exception as e:
-        print(e)
-
-def setReadyFlag(m):
-    global ready
+# the decoder functions below publish what they decode through state
+# (see state.py); readers take a snapshot with state.get().
+
+nextRecord = 0.         # time the next row of history is due
+
+def record():
+    ''' Record the state in history, unless the last row was recorded
+        less than recordInterval ago: reports can come in much faster
+        than the chart shows them, and skipping them keeps a burst cheap.
+    '''
+    global nextRecord
+    t = time.time()
+    if nextRecord - recordInterval <= t < nextRecord:
+        return
+    nextRecord = t + recordInterval
+    history.record(state.get(), t)
+
+def setPositions(text):
+    ''' Update positions data from an M114 report:
+        "X:0.00 Y:0.00 Z:0.00 E:0.00 Count X:0 Y:0 Z:0".
+    '''
+    state.setPos(tuple([float(word[2:]) for word in text.split(None, 4)[:4]]))
+    record()
+
+# "T0:20.00 /0.00" in a temperature report; "T:" repeats the active hotend
+tempsReport = re.compile(r'(?<!\S)(T[01]:|B:)(\S+)\s+/(\S+)')
+
+def setTemperatures(text):
+    ''' Update all reported temperature data from an M105 report:
+        "T:20.00 /0.00 B:20.00 /0.00 T0:20.00 /0.00 T1:20.00 /0.00 @:0".
+    '''
+    temps = {key: (float(PV), float(SP)) for key, PV, SP in tempsReport.findall(text)}
+    if temps:
+        state.setTemps(temps)
+        record()
+
+def setReadyFlag(text):
     status.show('Printer ready\n')
-    ready = True
-
-def setExtruder(m):
-    ''' Update extruder selection. '''
-    global selectedExtruder
+    state.set(ready=True)
+
+def setExtruder(text):
+    ''' Update extruder selection from "echo:Active Extruder: 1". '''
+    state.set(extruder=int(text.rsplit(':', 1)[1]))
+
+def setWarmup(text):
+    ''' Update the temperature being waited for after M109
+        ("T:200.00 E:0 W:?") or M190 ("T:200.00 E:0 B:59.00").
+    '''
+    words = text.split()
+    if words[2].startswith('B:'):
+        state.setTemps({'B:': (float(words[2][2:]), None)})
+    else:
+        state.setTemps({'T'+words[1][2:]+':': (float(words[0][2:]), None)})
+    record()
+
+def setEcho(text):
+    ''' Echo messages: the end of the welcome message means ready.'''
+    msg = text[5:].lstrip()
+    if msg.startswith(('M217', 'SD init')):   # SD init: same for prusa i3
+        setReadyFlag(text)
+    elif msg.startswith('Active'):
+        setExtruder(msg)
+    else:
+        info.show(text + '\n')
+
+# decoder tables:
+# most traffic is temperature and position reports, so the decoder first
+# looks at how a message starts and only falls back to a regex for the
+# ones that do not start like any of these:
+prefixTable = (('T:', lambda text: (setWarmup if ' E:' in text
+                                    else setTemperatures)(text)),
+               ('X:', setPositions),
+               ('ok', lambda text: setTemperatures(text[2:])), # M105: ok T:..
+               ('echo:', setEcho),
+               ('Active', setExtruder))
+
+# the fallback: one regex with a named group per message type
+decoder_exp = re.compile(
+    r'(?P<temperatures>[BT][01]?:[+-]?\d*\.\d*\s*/\d*\.\d*)'
+    r'|(?P<positions>X:-?\d+\.\d+)'
+    r'|(?P<ready>echo:\s*(?:M217|SD\sinit))'
+    r'|(?P<extruder>Active\s+Extruder:\s*[01])')
+regexTable = {'temperatures': setTemperatures,
+              'positions': setPositions,
+              'ready': setReadyFlag,
+              'extruder': setExtruder}
+
+def decode(data):
+    ''' decode a single message from the printer. '''
+    text = data.strip()
     try:
-        selectedExtruder = int(m[0])
-    except Exception as e:
-        print(e)
-        
-def waitExtruder(m):
-    ''' Update temperature value for specified extruder. '''
-    tmp['T'+tuple(*m)[1]+':']['PV'] = float(tuple(*m)[0])
-    
-def waitBed(m):
-    ''' Update temperature value for heated bed.'''
-    tmp['B:']['PV'] = float(tuple(*m)[2])
-
-# decoder table and parser regex's:
-#m105report_exp = re.compile("[TB]\d*:([-+]?\d*\.?\d*)(?: ?\/)?([-+]?\d*\.?\d*)")
-m105report_exp = re.compile('([BT][01]?:)([+-]?\d*?\.\d*?)\s*?\/(\d*\.\d*)')
-m114report_exp = re.compile("[XYZE]:(-?\d+\.\d+)")
-ready_exp = re.compile("(echo:\s*M217).*") # last line in welcome message
-prusa_ready_exp = re.compile("(echo:\s*SD\sinit).*") # same for prusa i3
-actExt_exp = re.compile("Active\s+Extruder:\s*([01])")
-# following decodes msg after M109 or M190
-ext_warmup_exp = re.compile('^T:(\d*\.\d*)\s*E:(\d*)\s*(W:[?0-9]{1,2}$)$')
-bed_warmup_exp = re.compile('^T:(\d*\.\d*)\s*E:(\d*)\s*B:(\d*\.\d*)$')
-
-# when the regex in this table matches, the associated function is called
-decTable = [(m114report_exp, setPositions),
-            (m105report_exp, setTemperatures),
-            (ready_exp, setReadyFlag),
-            (prusa_ready_exp, setReadyFlag),
-            (actExt_exp, setExtruder),
-            (ext_warmup_exp, waitExtruder),
-            (bed_warmup_exp, waitBed)]
+        for prefix, function in prefixTable:
+            if text.startswith(prefix):
+                function(text)
+                return
+        m = decoder_exp.search(text)
+        if m:   # execute associated decoder function
+            regexTable[m.lastgroup](text[m.start():])
+            return
+    except (ValueError, IndexError, KeyError) as e:
+        print('decode:', e, repr(data))
+    info.show(data) # data is informational so show it                
 
 def decoder():
     ''' thread to monitor rcvQ and decode incoming data from printer. '''
-    global xmtQ, rcvQ, pos, tmp, kill, info, status
+    global xmtQ, rcvQ, kill, info, status
     status.show('decoder thread started\n')
     while not kill:
-        if not rcvQ.empty():
-            try:
-                data = rcvQ.get()
-                # decode message:
-                for regex, function in decTable:
-                    match = re.findall(regex, data)
-                    if match:   # execute associated decoder function
-                        function(match)
-                        break
-                else:   # no match:
-                    info.show(data) # data is informational so show it                
-            except queue.Empty:
-                pass
+        try:    # time out now and then to see if we've been killed
+            decode(rcvQ.get(timeout=0.1))
+        except queue.Empty:
+            pass
     # get here when killed:
     print('decoder killed')
 
@@ -122,15 +161,14 @@ def decoder():
 # helper functions
 #------------------------------------------------------------------------------    
 
-def progress(done, total, width):
-    '''Return progress string of width chars wide. '''
+def progress(done, total, width, left=None):
+    '''Return progress string of width chars wide, with the time left
+       (seconds) if given. '''
     if total:
-        s = '['
-        for i in range(width):
-            completed = width * done/total
-            s += '#'if i <= completed else '.'
-        s += '] {:3.1f}%\n'.format(100 * done/total)
-        return s
+        completed = min(width, int(width * done/total) + 1)
+        eta = '' if left is None else ' {}:{:02d} left'.format(*divmod(int(left) // 60, 60))
+        return '[{}{}] {:3.1f}%{}\n'.format('#' * completed, '.' * (width - completed),
+                                            100 * done/total, eta)
     else:
         return '\n'
     
@@ -5,8 +5,11 @@ from tkinter import ttk
 from tkinter import messagebox
 from tkinter import filedialog as fd
 from re import findall
+from queue import Empty
 
 import data as d
+import analysis
+import resume
 
 class Dialogpanel(ttk.Frame):
     
@@ -20,6 +23,8 @@ class Dialogpanel(ttk.Frame):
         self.ready = False
         self.filename = None
         self.path = None    # remember directory for next time
+        self.analyzer = None    # analysis.Analyzer of the file being opened
+        self.done = 0       # tenths of the analysis reported
         
         self.portOpenbtn = ttk.Button(self, command=self.openComms, 
                                       text = 'Connect', width=10)
@@ -29,17 +34,25 @@ class Dialogpanel(ttk.Frame):
                                        text='Motors Off', width=10)
         self.printbtn = ttk.Button(self,command=self.startPrint,
                                        text='Print', width=10)
+        self.resumebtn = ttk.Button(self,command=self.openResume,
+                                       text='Resume', width=10)
         self.abortbtn = ttk.Button(self,command=self.abortPrint,
                                        text='Abort', width=10)
+        self.statsbtn = ttk.Button(self,command=self.showStats,
+                                       text='Stats', width=10)
 
         self.portOpenbtn.grid(row=0, column=0, padx=2, pady=2)
         self.motorsOffbtn.grid(row=0, column=1, padx=2, pady=2)
         self.fileOpenbtn.grid(row=0, column=2, padx=2, pady=2)
         self.printbtn.grid(row=0, column=3, padx=2, pady=2)
-        self.abortbtn.grid(row=0, column=4, padx=2, pady=2)
+        self.resumebtn.grid(row=0, column=4, padx=2, pady=2)
+        self.abortbtn.grid(row=0, column=5, padx=2, pady=2)
+        if transport.metrics:
+            self.statsbtn.grid(row=0, column=6, padx=2, pady=2)
 
         self.enable((self.fileOpenbtn, self.portOpenbtn))
-        self.disable((self.motorsOffbtn, self.printbtn, self.abortbtn))
+        self.disable((self.motorsOffbtn, self.printbtn, self.resumebtn,
+                      self.abortbtn))
 
     def openComms(self):
         ''' pop up the open comms window to setp serial link.'''
@@ -47,7 +60,7 @@ class Dialogpanel(ttk.Frame):
             self.transport.disconnect(status = self.status)
             self.portOpenbtn.configure(text='Connect')
             if d.gcodeFile:
-                self.disable((self.printbtn, self.motorsOffbtn))
+                self.disable((self.printbtn, self.resumebtn, self.motorsOffbtn))
             return
         if self.lock:   # allow only one instance of subwindow
             return
@@ -88,6 +101,8 @@ class Dialogpanel(ttk.Frame):
                 self.enable((self.motorsOffbtn))
                 if d.gcodeFile:
                     self.enable(self.printbtn)
+                if d.analysis:
+                    self.enable(self.resumebtn)
         except ValueError:
             print('Invalid baudrate')
         finally:
@@ -100,31 +115,56 @@ class Dialogpanel(ttk.Frame):
         widget.destroy()
 
     def getfile(self):
-        try:
-            if d.gcodeFile: # do we already have a file open?
-                d.gcodeFile.close() # yes; close it!
-                d.gcodeFile = None
-            self.filename = fd.askopenfilename(filetypes=(('g-code','*.gcode'),
-                                                          ('all files', '*.*')), 
-                                               initialdir = "./testdata")
-            if self.filename:
-                # extract directory path and filename:
-                path = findall('(.*\/).*$', self.filename)[0]
-                self.path = path if path else None
-                file = findall('.*\/(.*)$', self.filename)[0]
-                self.status.show('Opening ' + file)
-                # open the file for later use:
-                d.gcodeFile = open(self.filename)
-                d.filesize = len(d.gcodeFile.readlines())
-                if d.connected: # printer is online and gcode file is open
-                    self.enable(self.printbtn)
-        except Exception as e:
-            messagebox.showerror('I/O Error', e)
+        ''' Select a gcode file and analyse it in the background; see poll().'''
+        if d.gcodeFile: # do we already have a file open?
+            d.gcodeFile.close() # yes; close it!
             d.gcodeFile = None
-        finally:
-            if self.filename:
-                self.status.show(' Failed\n' if not d.gcodeFile
-                             else ' ..Ok\n')  
+            d.analysis = None
+            self.disable((self.printbtn, self.resumebtn))
+        self.filename = fd.askopenfilename(filetypes=(('g-code',
+                                    ('*.gcode', '*.gcode.gz', '*.gcode.xz')),
+                                                      ('all files', '*.*')), 
+                                           initialdir = "./testdata")
+        if self.filename:
+            # extract directory path and filename:
+            path = findall('(.*\/).*$', self.filename)[0]
+            self.path = path if path else None
+            file = findall('.*\/(.*)$', self.filename)[0]
+            self.status.show('Opening ' + file)
+            self.disable(self.fileOpenbtn)
+            self.done = 0
+            self.analyzer = analysis.Analyzer(self.filename, d.arcTolerance)
+            self.analyzer.start()
+            self.after(100, self.poll)
+
+    def poll(self):
+        ''' Report the progress of the file analysis and take over the
+            file when it is done.
+        '''
+        while True:
+            try:
+                msg = self.analyzer.queue.get_nowait()
+            except Empty:
+                self.after(100, self.poll)
+                return
+            if msg[0] == 'progress':
+                while self.done < int(msg[1] * 10):    # a dot per 10%
+                    self.status.show('.')
+                    self.done += 1
+            else:
+                break
+        self.analyzer = None
+        self.enable(self.fileOpenbtn)
+        if msg[0] == 'error':
+            self.status.show(' Failed\n')
+            messagebox.showerror('I/O Error', msg[1])
+            return
+        d.gcodeFile, d.analysis = msg[1], msg[2]
+        d.filesize = len(d.gcodeFile)
+        self.status.show(' ..Ok\n')
+        self.info.show(d.analysis.report())
+        if d.connected: # printer is online and gcode file is open
+            self.enable((self.printbtn, self.resumebtn))
             
     def powerDown(self):
         ''' Send M81 to turn motor power off. '''
@@ -133,19 +173,86 @@ class Dialogpanel(ttk.Frame):
     def startPrint(self):
         if self.transport.start_print():
             self.status.show('Printing {} lines\n'.format(d.filesize))
-            self.enable(self.abortbtn)
-            self.disable((self.motorsOffbtn, self.printbtn,
-                    self.portOpenbtn, self.fileOpenbtn))
+            self.printing()
+
+    def printing(self):
+        ''' Set the buttons for a running print.'''
+        self.enable(self.abortbtn)
+        self.disable((self.motorsOffbtn, self.printbtn, self.resumebtn,
+                self.portOpenbtn, self.fileOpenbtn))
+
+    def openResume(self):
+        ''' pop up the resume window to restart the print at a layer or
+            a line.
+        '''
+        if self.lock or d.analysis is None:  # one subwindow, for an analysed file
+            return
+        self.lock = True
+        window = tk.Toplevel(self, bg='black')
+        window.title('Resume Print')
+        window.protocol('WM_DELETE_WINDOW', lambda: self.shutdown(window))
+
+        label1 = ttk.Label(window, text='Layer (1-{}): '.format(len(d.analysis.layers)))
+        entry1 = ttk.Entry(window, width=12)
+        label2 = ttk.Label(window, text='or line (1-{}): '.format(d.filesize))
+        entry2 = ttk.Entry(window, width=12)
+        okBtn = ttk.Button(window, width=8,
+                           command=lambda: self.resumePrint(entry1.get(),
+                                            entry2.get(), window),
+                           text='OK')
+        cancelBtn = ttk.Button(window, width=8,
+                               command=lambda: self.shutdown(window),
+                               text='Cancel')
+
+        label1.grid(row=0, column=0, columnspan=3, pady=10, padx=5, sticky='W')
+        entry1.grid(row=0, column=2, columnspan=2, pady=10, padx=5, sticky='E')
+        label2.grid(row=1, column=0, columnspan=3, pady=10, padx=5, sticky='W')
+        entry2.grid(row=1, column=2, columnspan=2, pady=10, padx=5, sticky='E')
+        okBtn.grid(row=2, column=1, pady=10, padx=5)
+        cancelBtn.grid(row=2, column=2, pady=10, padx=5)
+        entry1.focus_set()
+
+    def resumePrint(self, layer, line, widget):
+        ''' Restore the machine state before the layer or line and print
+            from there; see resume.
+        '''
+        try:
+            if layer.strip():
+                n = int(layer)
+                if not 1 <= n <= len(d.analysis.layers):
+                    raise ValueError
+                line = d.analysis.layers[n - 1].line
+            else:
+                line = int(line) - 1
+                if not 0 <= line < d.filesize:
+                    raise ValueError
+        except ValueError:
+            messagebox.showerror('Resume', 'Invalid layer or line')
+            return
+        self.shutdown(widget)
+        line = resume.runStart(d.analysis.arcs, line)
+        machine = resume.locate(d.gcodeFile, d.analysis.checkpoints, line)
+        commands = resume.prologue(machine)
+        self.info.show('Resume at line {}:\n{}\n'.format(line + 1, '\n'.join(commands)))
+        if self.transport.start_print(line, commands):
+            self.status.show('Printing lines {}-{}\n'.format(line + 1, d.filesize))
+            self.printing()
     
     def abortPrint(self):
         self.transport.abort_print()
         self.status.show('\nAbort\n')
         self.stopPrint()
 
+    def showStats(self):
+        ''' Show the transport metrics of the current or last job.'''
+        self.info.show(self.transport.metrics.report())
+
     def stopPrint(self):
         self.disable(self.abortbtn)
         self.enable((self.motorsOffbtn, self.portOpenbtn, 
                      self.fileOpenbtn, self.printbtn))
+        if d.analysis:  # resume needs the analysis of the file
+            self.enable(self.resumebtn)
                 
     def enable(self, btns):
         ''' Set state of specified buttons to 'normal'.'''
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module contains the print time estimator for the 3D-Gui program.
+
+The estimator models the motion planner of Marlin 2 on the tokenized job
+(see tokenizer) to predict how long every line takes:
+  - the nominal speed of a move is its feedrate, scaled down so that no
+    axis exceeds its maximum feedrate (M203)
+  - its acceleration is the print, travel or retract acceleration (M204)
+    limited by the maximum acceleration of each axis moving (M201)
+  - the speed through a corner is limited by junction deviation, and for
+    segments below 1 mm by the centripetal acceleration of the curve
+  - the planner slows down to a stop before G4, G28, M109, M190, M400
+  - each move runs a trapezoid: accelerate, cruise, decelerate
+The forward and backward passes of the planner are recurrences of the
+form v[i] = min(limit[i], v[i-1] + 2 a L), evaluated as prefix minima of
+cumulative sums, so a whole chunk of rows is planned with a few NumPy
+operations. The planner state crosses chunk boundaries only through the
+exit speed of the last move, so moves right before a boundary do not
+slow down for a corner just behind it. The job ends at a standstill:
+times() plans the last chunk again with the exit speed of its last move
+limited to 0. Heating and homing take no time in the model, dwells (G4)
+do.
+
+Estimator.add() takes the chunks of one pass over the job, times()
+returns the estimated time at the end of each line, cumulative.
+"""
+import numpy as np
+
+import tokenizer
+
+# Marlin's defaults (Configuration.h), X Y Z E:
+MAXFEED = (300., 300., 5., 25.)         # mm/s
+MAXACCEL = (3000., 3000., 100., 10000.)    # mm/s²
+ACCEL = 3000.                           # print, travel, retract mm/s²
+JUNCTION = 0.013                        # junction deviation mm
+FEED = 1500.                            # feedrate before the first F, mm/min
+STOPS = ((b'G', 4), (b'G', 28), (b'M', 109), (b'M', 190), (b'M', 400))
+
+
+def _fill(values, carry):
+    ''' values with NaN replaced by the last value before (carry at the
+        start); returns the filled values and the new carry.
+    '''
+    known = ~np.isnan(values)
+    latest = np.maximum.accumulate(np.where(known, np.arange(len(values)), -1))
+    filled = np.where(latest >= 0, values[np.maximum(latest, 0)], carry)
+    return filled, (filled[-1] if len(filled) else carry)
+
+
+def _scan(limit, gain):
+    ''' u[i] = min(limit[i], u[i-1] + gain[i-1]) for all i, u[0] = limit[0].'''
+    total = np.concatenate(([0.], np.cumsum(gain)))[:len(limit)]
+    return total + np.minimum.accumulate(limit - total)
+
+
+class Estimator():
+    ''' Print time estimate of one job, fed chunk by chunk.'''
+
+    def __init__(self, lines, maxFeed=MAXFEED, maxAccel=MAXACCEL,
+                 accel=ACCEL, junction=JUNCTION):
+        self.elapsed = np.zeros(lines)  # time at the end of each line
+        self.time = 0.                  # time so far
+        self.junction = junction
+        self.feed = FEED
+        self.maxFeed = list(maxFeed)    # the settings in effect, updated by
+        self.maxAccel = list(maxAccel)  # M201, M203, M204 in the job
+        self.accel = [accel] * 3        # print, travel, retract
+        self.exit = 0.                  # exit speed² of the last move
+        self.direction = np.zeros(3)    # unit vector at its end
+        self.nominal = 0.               # its nominal speed²
+        self.last = None                # the last chunk and the state before it
+
+    def add(self, rows, prev, after, end=False):
+        ''' Plan the rows of a chunk; prev and after are the positions
+            before and after each row (see tokenizer.positions). With
+            end the last move stops at its end.
+        '''
+        self.last = (rows, prev, after, self._state())
+        cmd, code = rows['cmd'], rows['code']
+        g = cmd == b'G'
+        m = cmd == b'M'
+        feed, self.feed = _fill(rows['F'], self.feed)
+        settings = self._settings(rows, m, code)
+
+        delta = after - prev
+        move = g & (code >= 0) & (code <= 3)
+        arc = move & (code >= 2)
+        xyz = np.sqrt((delta[:, :3] ** 2).sum(1))
+        if arc.any():
+            xyz[arc] = self._arcs(rows[arc], prev[arc], after[arc], delta[arc])
+        length = np.where(xyz > 0, xyz, np.abs(delta[:, 3]))
+        move &= length > 0
+        stop = np.zeros(len(rows), bool)
+        for c, n in STOPS:
+            stop |= (cmd == c) & (code == n)
+        stops = np.cumsum(stop)
+
+        index = np.flatnonzero(move)
+        seconds = np.zeros(len(rows))
+        dwell = g & (code == 4)
+        seconds[dwell] = np.nan_to_num(rows['P'][dwell]) / 1000 + np.nan_to_num(rows['S'][dwell])
+        if len(index):
+            stopped = np.empty(len(index), bool)     # a stop since the move before
+            stopped[0] = stops[index[0]] > 0
+            stopped[1:] = np.diff(stops[index]) > 0
+            seconds[index] = self._plan(rows, index, delta[index], length[index], xyz[index],
+                                        feed[index], [s[index] for s in settings],
+                                        stopped, prev, after, arc, end)
+        if len(rows) and stops[-1] > (stops[index[-1]] if len(index) else 0):
+            self.exit = 0.
+        cumulative = self.time + np.cumsum(seconds)
+        self.elapsed[rows['line']] = cumulative
+        if len(rows):
+            self.time = cumulative[-1]
+
+    def _state(self):
+        ''' The planner state carried from chunk to chunk.'''
+        return (self.time, self.feed, list(self.maxFeed), list(self.maxAccel),
+                list(self.accel), self.exit, self.direction, self.nominal)
+
+    def _settings(self, rows, m, code):
+        ''' The per row maximum feedrates, maximum accelerations and
+            print, travel, retract accelerations.
+        '''
+        columns = []
+        for mcode, params, carry in ((203, 'XYZE', self.maxFeed), (201, 'XYZE', self.maxAccel),
+                                     (204, 'PTR', self.accel)):
+            here = m & (code == mcode)
+            for k, p in enumerate(params):
+                values = np.where(here, rows[p], np.nan)
+                if mcode == 204 and p != 'R':   # S sets print and travel
+                    values = np.where(here & np.isnan(values), rows['S'], values)
+                filled, carry[k] = _fill(values, carry[k])
+                columns.append(filled)
+        return columns
+
+    def _arcs(self, rows, prev, after, delta):
+        ''' Length of the G2/G3 moves rows: helical arcs given by a
+            centre offset I J or a radius R.
+        '''
+        clockwise = rows['code'] == 2
+        i, j, r = rows['I'], rows['J'], rows['R']
+        chord = np.hypot(delta[:, 0], delta[:, 1])
+        byRadius = np.isnan(i) & np.isnan(j) & ~np.isnan(r)
+        radius = np.where(byRadius, np.abs(r), np.hypot(np.nan_to_num(i), np.nan_to_num(j)))
+        start = np.arctan2(-np.nan_to_num(j), -np.nan_to_num(i))
+        end = np.arctan2(after[:, 1] - prev[:, 1] - np.nan_to_num(j),
+                         after[:, 0] - prev[:, 0] - np.nan_to_num(i))
+        sweep = np.where(clockwise, start - end, end - start) % (2 * np.pi)
+        sweep[(sweep == 0) & ~byRadius] = 2 * np.pi    # full circle
+        byChord = 2 * np.arcsin(np.clip(chord / np.maximum(2 * radius, 1e-9), 0, 1))
+        sweep = np.where(byRadius, np.where(r < 0, 2 * np.pi - byChord, byChord), sweep)
+        return np.hypot(sweep * radius, delta[:, 2])
+
+    def _plan(self, rows, index, delta, length, xyz, feed, settings, stopped, prev, after,
+              arc, end):
+        ''' Seconds for each of the moves; index are their rows. With
+            end the last one stops.
+        '''
+        maxFeed = np.stack(settings[0:4], 1)
+        maxAccel = np.stack(settings[4:8], 1)
+        printing, travel, retract = settings[8:11]
+        unit = np.abs(delta) / length[:, None]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            speed = np.minimum(feed / 60, np.nan_to_num(maxFeed / unit, nan=np.inf,
+                                                        posinf=np.inf).min(1))
+            extruding = delta[:, 3] != 0
+            accel = np.where(xyz == 0, retract, np.where(extruding, printing, travel))
+            accel = np.minimum(accel, np.nan_to_num(maxAccel / unit, nan=np.inf,
+                                                    posinf=np.inf).min(1))
+        nominal = speed ** 2
+
+        # direction at the start and end of each move, XYZ:
+        direction = np.where(xyz[:, None] > 0, delta[:, :3] / np.maximum(xyz, 1e-12)[:, None], 0.)
+        first, last = direction, direction
+        isArc = arc[index]
+        if isArc.any():     # tangents of the arcs
+            first, last = direction.copy(), direction.copy()
+            arcs = index[isArc]
+            i, j = np.nan_to_num(rows['I'][arcs]), np.nan_to_num(rows['J'][arcs])
+            centre = prev[arcs, :2] + np.stack((i, j), 1)
+            sign = np.where(rows['code'][arcs] == 2, -1., 1.)[:, None]
+            for target, point in ((first, prev[arcs, :2]), (last, after[arcs, :2])):
+                radial = point - centre
+                radial /= np.maximum(np.hypot(radial[:, 0], radial[:, 1]), 1e-12)[:, None]
+                target[isArc, :2] = sign * np.stack((-radial[:, 1], radial[:, 0]), 1)
+                target[isArc, 2] = 0.
+
+        # junction speed² at the start of each move:
+        before = np.vstack((self.direction, last[:-1]))
+        cosine = -(before * first).sum(1)
+        half = np.sqrt(np.clip(0.5 * (1 - cosine), 0, 1))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            junction = np.where(half < 1, accel * self.junction * half / (1 - half), np.inf)
+            deflection = np.arccos(np.clip(-cosine, -1, 1))
+            junction = np.where((length < 1) & (deflection > 0),
+                                np.minimum(junction, length * accel / deflection), junction)
+        junction[cosine > 0.999999] = 0.    # reversal
+        junction = np.minimum(junction, np.minimum(nominal, np.append(self.nominal, nominal[:-1])))
+        junction[stopped] = 0.
+        junction[0] = min(junction[0], self.exit)
+
+        # backward pass (from a standstill at the end of the job, else
+        # unconstrained) and forward pass:
+        gain = 2 * accel * length
+        limit = np.append(junction, 0. if end else nominal[-1])
+        backward = _scan(limit[::-1], gain[::-1])[::-1]
+        forward = _scan(backward, gain)
+        entry, exit = forward[:-1], forward[1:]
+        self.exit, self.nominal, self.direction = exit[-1], nominal[-1], last[-1]
+
+        # trapezoids:
+        v0, v1, v = np.sqrt(entry), np.sqrt(exit), speed
+        accelerate = (nominal - entry) / (2 * accel)
+        decelerate = (nominal - exit) / (2 * accel)
+        cruise = length - accelerate - decelerate
+        peak = np.sqrt(np.maximum((2 * accel * length + entry + exit) / 2, 0))
+        return np.where(cruise >= 0,
+                        (v - v0) / accel + (v - v1) / accel + np.maximum(cruise, 0) / v,
+                        (2 * peak - v0 - v1) / accel)
+
+    def finish(self):
+        ''' Plan the last chunk again, ending at a standstill.'''
+        if self.last:
+            rows, prev, after, state = self.last
+            (self.time, self.feed, self.maxFeed, self.maxAccel, self.accel,
+             self.exit, self.direction, self.nominal) = state
+            self.add(rows, prev, after, True)
+            self.last = None
+
+    def times(self):
+        ''' Estimated time in seconds at the end of each line.'''
+        self.finish()
+        return np.maximum.accumulate(self.elapsed)
+
+
+def estimate(job, **settings):
+    ''' Estimated time at the end of each line of Jobfile job.'''
+    estimator = Estimator(len(job), **settings)
+    pos = np.zeros(4)
+    for rows in tokenizer.parse(job):
+        start = pos.copy()
+        before = np.vstack((start, tokenizer.positions(rows, pos)))
+        estimator.add(rows, before[:-1], before[1:])
+    return estimator.times()
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module contains the print job compiler for the 3D-Gui program.
+
+Before a job is printed it is compiled once into a binary artifact that
+holds every executable line as a ready-to-send frame:
+    N<linenum> <command>*<checksum>\\n
+with comments and blank lines removed. Runs of lines fitted into arcs
+(see arcfit) are replaced by their G2/G3 as they are compiled; the frame
+of an arc maps to the first line of its run. Artifacts are cached by the
+hash of the gcode file and the arc fitting, so reprinting a job skips
+the compile step. The background analysis builds the artifact when the
+file is opened (see analysis), so starting a print only maps it, and the
+print thread only has to slice a frame out of the memory map and write
+it. The checksums are computed with NumPy, BATCH frames at a time.
+
+A compressed gcode file (see jobfile) is not inflated onto disk by its
+compile either: its artifact is packed, the frames are stored zlib
+compressed in blocks of BLOCK frames, and frame() keeps at most two
+blocks inflated. The transport reads the frames in order, so each block
+is inflated once per print. The cache is bound by size as well as by
+count: the least recently used artifacts are removed beyond maxEntries
+or maxBytes, the newest is always kept.
+
+Artifact layout (all integers in native byte order):
+    frames      concatenated frames (packed: compressed blocks)
+    offsets     uint64 * (count+1), start of each frame relative to 0
+                (packed: of each block, uint64 * (blocks+1))
+    srcLine     uint32 * count, source line index of each frame
+                (padded to a multiple of 8 bytes)
+    trailer     uint64 count, uint64 number of source lines, MAGIC
+                (packed: PACKED)
+"""
+import mmap
+import os
+import struct
+import threading
+import zlib
+from array import array
+from itertools import accumulate, islice
+
+import numpy as np
+
+import jobfile
+
+cacheDir = os.path.join(os.path.expanduser('~'), '.cache', '3d-o-matic')
+maxEntries = 20         # number of compiled jobs kept in the cache
+maxBytes = 2 << 30      # total size of the compiled jobs kept
+MAGIC = b'3DOMJOB1'
+PACKED = b'3DOMJOZ1'
+TRAILER = struct.Struct('<QQ8s')
+BATCH = 1 << 16         # frames checksummed at once
+BLOCK = 1 << 12         # frames compressed together in a packed artifact
+
+
+class Compiledjob():
+    ''' Memory mapped view on a compiled job artifact.'''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.blocks = {}        # inflated blocks of a packed artifact
+        self.lock = threading.Lock()    # guards blocks
+        self.file = open(filename, 'rb')
+        try:
+            self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:      # empty file
+            self.file.close()
+            raise
+        size = len(self.mm)
+        count, self.lines, magic = (TRAILER.unpack_from(self.mm, size - TRAILER.size)
+                                    if size >= TRAILER.size else (0, 0, b''))
+        self.packed = magic == PACKED
+        entries = -(-count // BLOCK) + 1 if self.packed else count + 1
+        tables = size - TRAILER.size - _padded(4*count) - 8*entries
+        if magic not in (MAGIC, PACKED) or tables < 0:  # or truncated
+            self.close()
+            raise ValueError('{} is not a compiled job'.format(filename))
+        self.view = memoryview(self.mm)
+        self.offsets = self.view[tables:tables + 8*entries].cast('Q')
+        tables += 8*entries
+        self.srcLine = self.view[tables:tables + 4*count].cast('I')
+
+    def __len__(self):
+        ''' Number of frames in the job.'''
+        return len(self.srcLine)
+
+    def frame(self, index):
+        ''' Return frame [index] as bytes, including the newline.'''
+        if self.packed:
+            block, index = divmod(index, BLOCK)
+            frames = self.blocks.get(block)
+            return (frames or self._inflate(block))[index]
+        return self.mm[self.offsets[index]:self.offsets[index+1]]
+
+    def _inflate(self, block):
+        ''' The frames of block [block] of a packed artifact, keeping it
+            and the one used before.
+        '''
+        frames = zlib.decompress(
+            self.mm[self.offsets[block]:self.offsets[block+1]]).splitlines(True)
+        with self.lock:         # the receiver reads frames as well
+            if len(self.blocks) > 1:
+                del self.blocks[next(iter(self.blocks))]
+            self.blocks[block] = frames
+        return frames
+
+    def close(self):
+        if getattr(self, 'view', None):
+            self.offsets.release()
+            self.srcLine.release()
+            self.view.release()
+            self.view = None
+        self.mm.close()
+        self.file.close()
+
+
+def _padded(n):
+    return (n + 7) & ~7
+
+
+def _frames(prefixes):
+    ''' The frames for the list of "N<linenum> <command>" prefixes.'''
+    data = np.frombuffer(b''.join(prefixes), np.uint8)
+    starts = np.fromiter(accumulate(map(len, prefixes[:-1]), initial=0),
+                         np.int64, len(prefixes))
+    sums = np.bitwise_xor.reduceat(data, starts).tolist()
+    return [b'%s*%d\n' % (prefix, sum) for prefix, sum in zip(prefixes, sums)]
+
+
+def compile(job, filename, arcs=None, packed=False):
+    ''' Compile Jobfile job into the artifact filename, applying the
+        arcfit.Arcs arcs if given, packed if asked for. Frames are
+        numbered from 0 on; the transport resets Marlin's line number
+        with "N-1 M110" before sending frame 0.
+    '''
+    pack = _pack if packed else None
+    offsets = array('Q', [0])
+    srcLine = array('I')
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        write = f.write
+        prefixes = []           # frames to be checksummed
+        runs = arcs.runs if arcs else {}
+        skip = -1               # last line of the arc being skipped
+        for i, line in enumerate(job.lines()):
+            if i <= skip:
+                continue
+            if i in runs:
+                skip, command = runs[i]
+            else:
+                command = line.split(b';', 1)[0].strip()
+            if not command:     # skip empty lines and comments
+                continue
+            prefixes.append(b'N%d %s' % (len(srcLine), command))
+            srcLine.append(i)
+            if len(prefixes) == BATCH:
+                _write(write, _frames(prefixes), offsets, pack)
+                prefixes = []
+        if prefixes:
+            _write(write, _frames(prefixes), offsets, pack)
+        write(offsets.tobytes())
+        write(srcLine.tobytes().ljust(_padded(4*len(srcLine)), b'\0'))
+        write(TRAILER.pack(len(srcLine), len(job), PACKED if packed else MAGIC))
+    os.replace(tmp, filename)   # never leave a half written artifact
+
+
+def _pack(frames):
+    ''' frames compressed in blocks of BLOCK; BATCH is a multiple of
+        BLOCK, so only the last block of a job is shorter.
+    '''
+    return [zlib.compress(b''.join(frames[i:i + BLOCK]))
+            for i in range(0, len(frames), BLOCK)]
+
+
+def _write(write, frames, offsets, pack=None):
+    ''' Write frames and append their ends to offsets; with pack, the
+        frames are written in compressed blocks, and the ends of those.
+    '''
+    if pack:
+        frames = pack(frames)
+    write(b''.join(frames))
+    offsets.extend(islice(accumulate(map(len, frames), initial=offsets[-1]), 1, None))
+
+
+def load(job, status=None, arcs=None):
+    ''' Return the Compiledjob for Jobfile job with the arcfit.Arcs arcs
+        applied, compiling it first if it is not in the cache yet. The
+        artifact of a compressed job (a jobfile.Streamfile) is packed.
+    '''
+    os.makedirs(cacheDir, exist_ok=True)
+    packed = isinstance(job, jobfile.Streamfile)
+    key = job.digest() + ('-' + arcs.key() if arcs else '') + ('-z' if packed else '')
+    filename = os.path.join(cacheDir, key + '.job')
+    if os.path.exists(filename):
+        os.utime(filename)      # mark as recently used
+        try:
+            return Compiledjob(filename)
+        except ValueError:      # stale or damaged artifact: rebuild it
+            pass
+    if status:
+        status.show('Compiling job..')
+    compile(job, filename, arcs, packed)
+    _prune()
+    if status:
+        status.show(' done\n')
+    return Compiledjob(filename)
+
+
+def _prune():
+    ''' Remove the least recently used artifacts beyond maxEntries or
+        maxBytes.
+    '''
+    entries = []
+    for f in os.listdir(cacheDir):
+        if f.endswith('.job'):
+            try:
+                stat = os.stat(os.path.join(cacheDir, f))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, os.path.join(cacheDir, f)))
+    entries.sort(reverse=True)
+    total = 0
+    for i, (mtime, size, filename) in enumerate(entries):
+        total += size
+        if i and (i >= maxEntries or total > maxBytes):
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
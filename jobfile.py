@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module contains the job file layer for the 3D-Gui program.
+
+A gcode job is not read into memory as a list of strings. Instead the
+file is memory mapped and a compact index holding the byte offset of
+every line is built in a single pass. Lines are decoded lazily, only
+when the transport asks for them.
+
+Compressed jobs (gzip or xz, recognised by their magic number) cannot be
+mapped. A Streamfile indexes them in a streaming first pass, READAHEAD
+bytes of decompressed data at a time, and decompresses again on demand:
+reading the lines in order (as the analysis and the job compiler do)
+streams through the file once, only going back to an earlier line
+restarts the decompression. The file is never inflated as a whole, in
+memory or on disk; its compiled artifact is compressed as well (see
+jobcache). Offsets, size() and digest() are those of the decompressed
+data, so the gzip and the xz file of a job share their artifact.
+"""
+import gzip
+import hashlib
+import lzma
+import mmap
+import os
+import threading
+from array import array
+
+READAHEAD = 1 << 20     # bytes decompressed at a time by the first pass
+# magic number, decompressing reader on a file object:
+FORMATS = ((b'\x1f\x8b', lambda f: gzip.GzipFile(fileobj=f)),
+           (b'\xfd7zXZ\x00', lzma.LZMAFile))
+
+
+def openJob(filename, progress=None):
+    ''' Return a Jobfile for filename, or a Streamfile if the file is
+        compressed. progress is called with the fraction of a compressed
+        file indexed.
+    '''
+    with open(filename, 'rb') as f:
+        magic = f.read(6)
+    for prefix, reader in FORMATS:
+        if magic.startswith(prefix):
+            return Streamfile(filename, reader, progress)
+    return Jobfile(filename)
+
+
+class Jobfile():
+    ''' Read-only, line indexed view on a gcode file.'''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.mm = None          # memory map of the file (None if empty)
+        self.offsets = array('Q', [0])  # start of each line + end of file
+        self._digest = None     # content hash, computed on first use
+        self.file = open(filename, 'rb')
+        try:
+            self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:      # empty files cannot be mapped
+            self.mm = None
+        self._index()
+
+    def _index(self):
+        ''' Scan the file once and record the offset of every line.'''
+        if not self.mm:
+            self.offsets = array('Q')
+            return
+        find = self.mm.find
+        append = self.offsets.append
+        size = len(self.mm)
+        pos = find(b'\n')
+        while pos >= 0:
+            append(pos + 1)
+            pos = find(b'\n', pos + 1)
+        if self.offsets[-1] != size:  # last line without newline
+            append(size)
+
+    def __len__(self):
+        ''' Number of lines in the file.'''
+        return max(0, len(self.offsets) - 1)
+
+    def __getitem__(self, index):
+        ''' Return line [index] as a string, including the newline.'''
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('line index out of range')
+        return self.raw(index).decode('ascii', errors='replace')
+
+    def raw(self, index):
+        ''' Return line [index] as bytes, including the newline.'''
+        return self.mm[self.offsets[index]:self.offsets[index+1]]
+
+    def block(self, start, stop):
+        ''' Return lines [start:stop] as bytes.'''
+        if start >= stop:
+            return b''
+        return self.mm[self.offsets[start]:self.offsets[stop]]
+
+    def lines(self):
+        ''' Iterate over the lines as bytes, including the newline.'''
+        if not self.mm:
+            return iter(())
+        self.mm.seek(0)
+        return iter(self.mm.readline, b'')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def digest(self):
+        ''' Hex digest of the file contents.'''
+        if self._digest is None:
+            self._digest = hashlib.sha1(self.mm if self.mm else b'').hexdigest()
+        return self._digest
+
+    def size(self):
+        ''' Size of the file in bytes.'''
+        return len(self.mm) if self.mm else 0
+
+    def close(self):
+        if self.mm:
+            self.mm.close()
+            self.mm = None
+        self.file.close()
+
+
+class Streamfile(Jobfile):
+    ''' Line indexed view on a compressed gcode file, see above.'''
+
+    def __init__(self, filename, reader, progress=None):
+        self.filename = filename
+        self.reader = reader    # decompressing reader on a file object
+        self.mm = None          # never mapped
+        self.offsets = array('Q', [0])  # start of each line + end of data
+        self._digest = None
+        self.file = None        # raw file of stream
+        self.stream = None      # reader for raw() and block(), opened on first use
+        self.lock = threading.Lock()    # guards stream
+        self._index(progress)
+
+    def _index(self, progress=None):
+        ''' Decompress the file once, recording the offset of every line
+            and hashing the contents.
+        '''
+        digest = hashlib.sha1()
+        buf = bytearray(READAHEAD)
+        find = buf.find
+        append = self.offsets.append
+        size = 0
+        with open(self.filename, 'rb') as f:
+            total = os.fstat(f.fileno()).st_size
+            with self.reader(f) as stream:
+                n = stream.readinto(buf)
+                while n:
+                    digest.update(memoryview(buf)[:n])
+                    pos = find(b'\n', 0, n)
+                    while pos >= 0:
+                        append(size + pos + 1)
+                        pos = find(b'\n', pos + 1, n)
+                    size += n
+                    if progress and total:
+                        progress(f.tell() / total)
+                    n = stream.readinto(buf)
+        if not size:
+            self.offsets = array('Q')
+        elif self.offsets[-1] != size:  # last line without newline
+            append(size)
+        self._digest = digest.hexdigest()
+
+    def raw(self, index):
+        ''' Return line [index] as bytes, including the newline.'''
+        return self.block(index, index + 1)
+
+    def block(self, start, stop):
+        ''' Return lines [start:stop] as bytes.'''
+        if start >= stop:
+            return b''
+        with self.lock:
+            if not self.stream:
+                self.file = open(self.filename, 'rb')
+                self.stream = self.reader(self.file)
+            self.stream.seek(self.offsets[start])   # backwards: starts over
+            return self.stream.read(self.offsets[stop] - self.offsets[start])
+
+    def lines(self):
+        ''' Iterate over the lines as bytes, including the newline.'''
+        with open(self.filename, 'rb') as f, self.reader(f) as stream:
+            yield from stream
+
+    def size(self):
+        ''' Size of the decompressed data in bytes.'''
+        return self.offsets[-1] if self.offsets else 0
+
+    def close(self):
+        with self.lock:
+            if self.stream:
+                self.stream.close()
+                self.file.close()
+                self.stream = self.file = None
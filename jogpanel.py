@@ -105,7 +105,7 @@ class Jogpanel(ttk.Frame):
         else:
             self.zZero = val
             data.xmtQ.put('G92 Z{}'.format(val))
-            data.homed.add('Z')
+            data.state.home('Z')
         finally:
             self.shutdown(obj)
             
@@ -145,7 +145,7 @@ class Jogpanel(ttk.Frame):
             return
         cmd = 'G28 {}'.format(axis if not axis == 'Z' else 'R10 Z')
         data.xmtQ.put(cmd)
-        data.homed.add(axis)
+        data.state.home(axis)
 
     def pressedUp(self, *args):
         self.ispressed = True
@@ -12,8 +12,8 @@ from ttkthemes import ThemedTk, themed_style
 import time
 
 # local imports:
-import data, pospanel, temppanel, jogpanel, \
-       dialogpanel, textpanel, transport as tr
+import data, pospanel, temppanel, jogpanel, chartpanel, \
+       dialogpanel, textpanel, transport as tr, asynctransport as atr
 
 def die():
    time.sleep(0.1)
@@ -28,10 +28,15 @@ data.gcodeFile = None
 data.fileSize = 0
 data.curline = 0
 data.linenum = 0
-data.ready = False
-data.homed = set()
 data.selectedAxis = None
-t0 = time.time()
+data.flowControl = 'ok'    # or 'chars' for char-counting flow control
+data.engine = 'threads'    # or 'asyncio' for the single event loop transport
+data.metrics = False       # True: collect send-to-ok latencies etc.
+data.arcTolerance = None   # or e.g. 0.025 to print G1 runs as arcs (needs ARC_SUPPORT)
+data.refreshInterval = 0.5 # seconds between gui refreshes (the refresh budget)
+seen = -1           # seq of the data.state snapshot shown in the gui
+printing = None     # transport.printing when last refreshed
+bar = None          # progress bar shown
 
 ''' 
 The start() and run() event handlers form a simple state machine, depending
@@ -42,8 +47,7 @@ operational updating of the gui is executed.
 '''
     
 def start():
-    global t0
-    if not data.ready:  # postpone transmission until printer ready
+    if not data.state.get().ready:  # postpone transmission until printer ready
         gui.after(500, start)  # loop here until printer ready
     else:
 #        data.xmtQ.put('M110 N'+str(data.linenum))   # init line number
@@ -51,43 +55,55 @@ def start():
         data.xmtQ.put('M155 S5')   # start auto temperatures report
         data.xmtQ.put('M302 P1')   # enable cold extrusion
         time.sleep(0.1)    # allow linenum to get updated by transceiver
-        t0 = time.time()      # get starttime for run()
         gui.after(10, run)     # start main event handler
     
 def run():   
-    global t0
-    if time.time() - t0 > 2.0:  # update the gui once per x seconds 
-        t0 = time.time()
+    global seen, printing, bar
+    # update the panels only when a new state snapshot was published; the
+    # panels in turn only touch widgets whose value changed:
+    state = data.state.get()
+    if state.seq != seen:
+        seen = state.seq
         # update positions panel:
-        pos.update(data.pos)
+        pos.update(state)
         # update temperatures:
-        e0tmp.setPV(data.tmp['T0:']['PV'])
-        e0tmp.setSP(data.tmp['T0:']['SP'])
-        e1tmp.setPV(data.tmp['T1:']['PV'])
-        e1tmp.setSP(data.tmp['T1:']['SP'])
-        bedtmp.setPV(data.tmp['B:']['PV'])
-        bedtmp.setSP(data.tmp['B:']['SP'])
-        if transport.printing:
-            # show progress bar
+        e0tmp.setPV(state.tmp['T0:'].PV)
+        e0tmp.setSP(state.tmp['T0:'].SP)
+        e1tmp.setPV(state.tmp['T1:'].PV)
+        e1tmp.setSP(state.tmp['T1:'].SP)
+        bedtmp.setPV(state.tmp['B:'].PV)
+        bedtmp.setSP(state.tmp['B:'].SP)
+    if transport.printing:
+        # show progress bar when it moved; by estimated time if known:
+        job, analysis = transport.job, data.analysis
+        if job and transport.maxIndex and analysis and analysis.times is not None:
+            line = job.srcLine[min(transport.queueindex, transport.maxIndex - 1)]
+            left = analysis.remaining(line)
+            total = analysis.times[-1]
+            progress = data.progress(total - left, total, 20, left)
+        else:
+            progress = data.progress(transport.queueindex, transport.maxIndex, 30)
+        if progress != bar:
+            bar = progress
             status.txt.config(state = 'normal')
-            status.txt.insert ('insert linestart', data.progress(transport.linenum, 
-                                                                  data.filesize, 
-                                                                  30))
+            status.txt.insert ('insert linestart', bar)
             status.txt.delete('insert linestart', 'end lineend')
-            status.txt.update()
             status.txt.config(state = 'disabled')
-            # disable jogging:
+    if transport.printing != printing:  # print started or ended
+        printing = transport.printing
+        if printing:    # disable jogging:
             jog.disable()
             pos.disable()
         else:
             jog.enable()
             pos.enable()
             dlgs.stopPrint()
+            bar = None
     # figure out what to do next:
-    if not data.ready:
+    if not state.ready:
         gui.after(10, start)    # restart comms when needed
     else:
-        gui.after(1000, run)
+        gui.after(int(1000 * data.refreshInterval), run)
 
 # create root level:
 gui = ThemedTk(theme="black")    # equilux is nice too     
@@ -98,8 +114,11 @@ gui.protocol('WM_DELETE_WINDOW', die)
 
 # add components to gui:
 status = textpanel.Textpanel(gui, ' System Status', h=7, w=40, sb=0)
-transport = tr.Transport(status=status)
-info = textpanel.Textpanel(gui, ' Info from Printer', h=15, w=90)
+if data.engine == 'asyncio':
+    transport = atr.AsyncTransport(status=status)
+else:
+    transport = tr.Transport(status=status)
+info = textpanel.Textpanel(gui, ' Info from Printer', h=15, w=90, maxLines=5000)
 dlgs = dialogpanel.Dialogpanel(gui, transport, info, status)
 jog = jogpanel.Jogpanel(gui, status)
 pos =  pospanel.Pospanel(gui)
@@ -109,6 +128,7 @@ e0tmp.setPV(180)
 bedtmp = temppanel.Temppanel(gui,'Heated Bed', '', 'M140')
 bedtmp.setScale(100)
 mdi = textpanel.Textpanel(gui, ' MDI', h=1, w=30, sb=0)
+chart = chartpanel.Chartpanel(gui, data.history)
 data.init(info, status)
 
 # place panels on the screen:
@@ -120,6 +140,7 @@ e0tmp.grid(row=1, column=2, padx=5, pady=1, sticky='SE')
 e1tmp.grid(row=2, column=2, padx=5, pady=1, sticky='SE')  
 bedtmp.grid(row=3, column=2, padx=5, pady=1, sticky='SE')  
 mdi.grid(row=3, column=0, columnspan=1, padx=5, pady=5, sticky='SW')
+chart.grid(row=5, column=0, columnspan=3, padx=5, pady=1, sticky='W')
 info.grid(row=6, column=0, columnspan=3, padx=5, pady=5, sticky='EW')
 
 start()
@@ -0,0 +1,448 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+A simulated Marlin printer for the 3D-Gui program.
+
+The simulator opens a pseudo-terminal and speaks the part of the Marlin
+protocol the transport relies on, so the transport can be tested and
+benchmarked without a printer on the bench:
+  - the welcome banner, ending in "echo: M217", after every (re)open
+    of the port - the equivalent of the DTR reset of a real board,
+  - line numbers and checksums (N..*..), M110, "Resend:" requests on
+    checksum errors (injectable) and on out of sequence lines,
+  - ADVANCED_OK replies "ok N<line> P<free planner> B<free buffers>",
+  - an RX buffer of rxsize bytes (overruns lose bytes, as on the real
+    board), bufsize command buffers and a planner of blocks slots that
+    executes one move per moveTime seconds, optionally a link latency,
+  - M104/M109/M140/M190 with simple heaters, M105 and M114 reports and
+    the M154/M155 position and temperature auto-reports.
+
+Run it stand-alone and point the gui's port setting at the device shown:
+    python3 marlinsim.py --move-time 0.005 --error-rate 0.001
+or use the Marlin class from a script:
+    sim = Marlin(moveTime=0.001); sim.start(); data.port = sim.port
+Linux only: resets are detected through the pty packet mode.
+"""
+import argparse
+import fcntl
+import json
+import os
+import random
+import re
+import select
+import struct
+import termios
+import threading
+import time
+import tty
+from collections import deque
+from functools import reduce
+
+BANNER = ('start\n'
+          'echo:Marlin 2.1.2 (simulated)\n'
+          'echo: Last Updated: 2023-03-24 | Author: (3D-O-Matic sim)\n'
+          'echo:Compiled: Mar 24 2023\n'
+          'echo: Free Memory: 2000  PlannerBufferBytes: 1232\n'
+          'echo:Hardcoded Default Settings Loaded\n'
+          'echo:  G21    ; Units in mm (mm)\n'
+          'echo:  M149 C ; Units in Celsius\n'
+          'echo: M217 Z2.00\n')
+
+wordExp = re.compile(r'([A-Z])([-+]?\d*\.?\d*)')
+
+
+class Heater():
+    ''' First order model of a heater.'''
+
+    def __init__(self, heatTime, ambient=21.0):
+        self.pv = ambient       # process value
+        self.sp = 0.0           # set point (0: off)
+        self.ambient = ambient
+        self.heatTime = heatTime    # time constant in seconds
+
+    def update(self, dt):
+        target = self.sp if self.sp else self.ambient
+        self.pv += (target - self.pv) * min(1.0, dt / self.heatTime)
+
+    def settled(self):
+        return abs(self.pv - (self.sp or self.ambient)) < 1.0
+
+
+class Marlin():
+    ''' The simulated printer. start() opens the pty and starts serving,
+        port holds the device name to connect to.
+    '''
+
+    def __init__(self, bufsize=4, rxsize=128, blocks=16, moveTime=0.01,
+                 errorRate=0.0, errors=(), heatTime=1.0, bootTime=0.2,
+                 latency=0.0):
+        self.bufsize = bufsize      # BUFSIZE: command buffers
+        self.rxsize = rxsize        # RX_BUFFER_SIZE in bytes
+        self.blocks = blocks        # BLOCK_BUFFER_SIZE: planner slots
+        self.moveTime = moveTime    # execution time per move
+        self.errorRate = errorRate  # probability of a checksum error per line
+        self.errors = set(errors)   # line numbers failing their checksum once
+        self.bootTime = bootTime    # delay between reset and banner
+        self.delay = latency / 2    # one way delay of the link
+        self.heaters = {'T0': Heater(heatTime), 'T1': Heater(heatTime),
+                        'B': Heater(heatTime * 3)}
+        self.port = None            # device name of the pty's slave side
+        self.master = None
+        self.slave = None
+        self.running = False
+        self.lock = threading.Condition()   # guards rx, commands and booted
+        self.outLock = threading.Lock()
+        self.rx = bytearray()       # RX buffer
+        self.inbound = deque()      # (arrival time, bytes) still on the wire
+        self.outbound = deque()     # (arrival time, bytes) on the way back
+        self.wire = threading.Condition()   # guards outbound
+        self.commands = deque()     # command buffers
+        self.planner = deque()      # finish times of planned moves
+        self.threads = []
+        self.stats = {'lines': 0, 'overflows': 0, 'errors': 0, 'resets': 0}
+        self._reset()
+
+    def _reset(self):
+        ''' Power-on state.'''
+        self.lastN = 0
+        self.booted = False
+        self.tool = 0
+        self.pos = [0.0, 0.0, 0.0, 0.0]
+        self.relative = False
+        self.relativeE = False
+        self.posInterval = 0        # M154 interval (s)
+        self.tempInterval = 0       # M155 interval (s)
+        self.nextPos = self.nextTemp = 0
+        for heater in self.heaters.values():
+            heater.sp = 0.0
+        del self.rx[:]
+        self.inbound.clear()
+        self.commands.clear()
+        self.planner.clear()
+
+    def start(self):
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        # packet mode reports the input flush the host does on open:
+        fcntl.ioctl(self.master, termios.TIOCPKT, struct.pack('i', 1))
+        self.port = os.ttyname(self.slave)
+        self.running = True
+        self.threads = [threading.Thread(target=self._receiver, daemon=True),
+                        threading.Thread(target=self._firmware, daemon=True),
+                        threading.Thread(target=self._line, daemon=True)]
+        for thread in self.threads:
+            thread.start()
+        return self.port
+
+    def stop(self):
+        self.running = False
+        with self.lock:
+            self.lock.notify_all()
+        with self.wire:
+            self.wire.notify_all()
+        for thread in self.threads:
+            thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    #--------------------------------------------------------------------------
+    # serial side
+    #--------------------------------------------------------------------------
+
+    def _receiver(self):
+        ''' Move bytes from the pty into the RX buffer.'''
+        while self.running:
+            if not select.select([self.master], [], [], 0.1)[0]:
+                continue
+            try:
+                packet = os.read(self.master, 4096)
+            except OSError:
+                continue
+            if packet[0] != termios.TIOCPKT_DATA:
+                if packet[0] & termios.TIOCPKT_FLUSHREAD:
+                    self._boot()    # host (re)opened the port
+                continue
+            with self.lock:
+                if self.delay:
+                    self.inbound.append((time.monotonic() + self.delay,
+                                         packet[1:]))
+                else:
+                    self._arrive(packet[1:])
+                self.lock.notify_all()
+
+    def _arrive(self, chunk):
+        ''' Bytes reach the RX buffer. Complete lines move on to free
+            command buffers while the bytes trickle in, as Marlin's idle
+            loop does; what finds no room is lost. Call with lock held.
+        '''
+        while chunk:
+            room = self.rxsize - len(self.rx)
+            if not room:    # overrun: bytes get lost
+                self.stats['overflows'] += 1
+                return
+            self.rx += chunk[:room]
+            chunk = chunk[room:]
+            self._slots()
+
+    def _boot(self):
+        with self.lock:
+            self._reset()
+            self.stats['resets'] += 1
+            self.bootAt = time.monotonic() + self.bootTime
+            self.lock.notify_all()
+
+    def _send(self, text):
+        if self.delay:
+            with self.wire:
+                self.outbound.append((time.monotonic() + self.delay,
+                                      text.encode('ascii')))
+                self.wire.notify()
+            return
+        with self.outLock:
+            os.write(self.master, text.encode('ascii'))
+
+    def _line(self):
+        ''' Deliver delayed output to the host.'''
+        while self.running:
+            with self.wire:
+                if not self.outbound:
+                    self.wire.wait(0.1)
+                    continue
+                due, chunk = self.outbound[0]
+                if due > time.monotonic():
+                    self.wire.wait(due - time.monotonic())
+                    continue
+                self.outbound.popleft()
+            with self.outLock:
+                os.write(self.master, chunk)
+
+    #--------------------------------------------------------------------------
+    # firmware
+    #--------------------------------------------------------------------------
+
+    def _firmware(self):
+        ''' Main loop: fetch commands, execute them, do auto-reports.'''
+        self.bootAt = None
+        while self.running:
+            with self.lock:
+                self._fetch()
+                if not self.commands:
+                    self.lock.wait(self.inbound[0][0] - time.monotonic()
+                                   if self.inbound else 0.05)
+                    self._fetch()
+                line = self.commands[0] if self.commands else None
+            self._idle()
+            if line is not None:
+                self._process(line)     # the line keeps its buffer till done
+                with self.lock:
+                    self.commands.popleft()
+                    self._fetch()
+
+    def _fetch(self):
+        ''' Take delivery of the bytes on the wire that are due and move
+            complete lines from the RX buffer into free command buffers.
+            Call with lock held.
+        '''
+        now = time.monotonic()
+        while self.inbound and self.inbound[0][0] <= now:
+            self._arrive(self.inbound.popleft()[1])
+        self._slots()
+
+    def _slots(self):
+        ''' Move complete lines into free command buffers.'''
+        while len(self.commands) < self.bufsize:
+            end = self.rx.find(b'\n')
+            if end < 0:
+                return
+            line = self.rx[:end].decode('ascii', 'replace').strip()
+            del self.rx[:end + 1]
+            if line:
+                self.commands.append(line)
+
+    def _idle(self):
+        ''' Banner, heaters and auto-reports.'''
+        now = time.monotonic()
+        if self.bootAt and now >= self.bootAt:
+            self.bootAt = None
+            self.booted = True
+            self._send(BANNER)
+        for heater in self.heaters.values():
+            heater.update(now - getattr(self, 'lastIdle', now))
+        self.lastIdle = now
+        if self.posInterval and now >= self.nextPos:
+            self.nextPos = now + self.posInterval
+            self._send(self._position() + '\n')
+        if self.tempInterval and now >= self.nextTemp:
+            self.nextTemp = now + self.tempInterval
+            self._send(' ' + self._temperatures() + '\n')
+
+    def _process(self, line):
+        self.stats['lines'] += 1
+        n = None
+        if line.startswith('N'):
+            star = line.rfind('*')
+            if star < 0:
+                return self._error('No Checksum with line number', self.lastN + 1)
+            m = re.match(r'N(-?\d+)\s*', line)
+            if not m:   # mangled line number, e.g. after an RX overrun
+                return self._error('checksum mismatch', self.lastN + 1)
+            n = int(m.group(1))
+            corrupt = n in self.errors or random.random() < self.errorRate
+            checksum = reduce(lambda x, y: x ^ y, line[:star].encode('ascii'), 0)
+            if corrupt or line[star+1:] != str(checksum):
+                self.errors.discard(n)
+                return self._error('checksum mismatch', self.lastN + 1)
+            command = line[m.end():star].strip()
+            if 'M110' not in command and n != self.lastN + 1:
+                return self._error('Line Number is not Last Line Number+1',
+                                   self.lastN + 1)
+            self.lastN = n
+        else:
+            command = line
+        reply = self._execute(command)
+        self._send(reply if reply.startswith('ok') else reply + self._ok())
+
+    def _error(self, message, resend):
+        self.stats['errors'] += 1
+        # like Marlin's flush_and_request_resend(): a plain ok follows
+        self._send('Error:{}, Last Line: {}\nResend: {}\nok\n'
+                   .format(message, self.lastN, resend))
+
+    def _ok(self):
+        return 'ok N{} P{} B{}\n'.format(self.lastN,
+                                        self.blocks - len(self._drain()),
+                                        self.bufsize - len(self.commands))
+
+    def _drain(self):
+        ''' Drop the moves executed by now from the planner.'''
+        now = time.monotonic()
+        while self.planner and self.planner[0] <= now:
+            self.planner.popleft()
+        return self.planner
+
+    def _execute(self, command):
+        ''' Execute command; returns the text to send before the ok.'''
+        words = wordExp.findall(command)
+        if not words:
+            return ''
+        code = words[0][0] + words[0][1]
+        args = {letter: value for letter, value in words[1:]}
+        if code in ('G0', 'G1', 'G2', 'G3', 'G28'):
+            self._move(args, home=code == 'G28')
+        elif code == 'G90':
+            self.relative = self.relativeE = False
+        elif code == 'G91':
+            self.relative = self.relativeE = True
+        elif code == 'M82':
+            self.relativeE = False
+        elif code == 'M83':
+            self.relativeE = True
+        elif code == 'G92':
+            for i, axis in enumerate('XYZE'):
+                if axis in args:
+                    self.pos[i] = float(args[axis] or 0)
+        elif code == 'M110':
+            if 'N' in args:
+                self.lastN = int(args['N'])
+        elif code in ('M104', 'M109', 'M140', 'M190'):
+            heater = 'B' if code in ('M140', 'M190') else \
+                     'T' + args.get('T', str(self.tool))
+            self.heaters[heater].sp = float(args.get('S', 0) or 0)
+            if code in ('M109', 'M190'):
+                self._heatUp(self.heaters[heater], heater == 'B')
+        elif code == 'M105':
+            return 'ok ' + self._temperatures() + '\n'    # no separate ok
+        elif code == 'M114':
+            return self._position() + '\n'
+        elif code == 'M154':
+            self.posInterval = float(args.get('S', 0) or 0)
+        elif code == 'M155':
+            self.tempInterval = float(args.get('S', 0) or 0)
+        elif words[0][0] == 'T':
+            self.tool = int(words[0][1] or 0)
+            return 'echo:Active Extruder: {}\n'.format(self.tool)
+        return ''
+
+    def _move(self, args, home=False):
+        ''' Queue a move in the planner, waiting for a free slot.'''
+        for i, axis in enumerate('XYZE'):
+            if home:
+                if axis in args or len(args) == 0:
+                    self.pos[i] = 0.0
+            elif axis in args:
+                value = float(args[axis] or 0)
+                relative = self.relativeE if axis == 'E' else self.relative
+                self.pos[i] = self.pos[i] + value if relative else value
+        planner = self._drain()
+        if len(planner) >= self.blocks:     # planner full: wait for a slot
+            time.sleep(max(0, planner[0] - time.monotonic()))
+            planner.popleft()
+        start = planner[-1] if planner else time.monotonic()
+        planner.append(max(start, time.monotonic()) + self.moveTime)
+
+    def _heatUp(self, heater, bed):
+        ''' M109/M190: report once per second until the set point is
+            reached.
+        '''
+        last = time.monotonic()
+        while self.running and not heater.settled():
+            time.sleep(min(1.0, heater.heatTime / 5))
+            now = time.monotonic()
+            heater.update(now - last)
+            last = now
+            if bed:
+                self._send('T:{:.2f} E:0 B:{:.2f}\n'.format(
+                           self.heaters['T0'].pv, heater.pv))
+            else:
+                self._send('T:{:.2f} E:{} W:?\n'.format(heater.pv, self.tool))
+        self.lastIdle = time.monotonic()
+
+    def _temperatures(self):
+        t = self.heaters
+        return ('T:{0:.2f} /{1:.2f} B:{2:.2f} /{3:.2f} T0:{0:.2f} /{1:.2f} '
+                'T1:{4:.2f} /{5:.2f} @:0 B@:0'.format(
+                t['T' + str(self.tool)].pv, t['T' + str(self.tool)].sp,
+                t['B'].pv, t['B'].sp, t['T1'].pv, t['T1'].sp))
+
+    def _position(self):
+        return 'X:{:.2f} Y:{:.2f} Z:{:.2f} E:{:.2f} Count X:0 Y:0 Z:0' \
+               .format(*self.pos)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                             formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--bufsize', type=int, default=4,
+                        help='number of command buffers (BUFSIZE)')
+    parser.add_argument('--rxsize', type=int, default=128,
+                        help='RX buffer size in bytes (RX_BUFFER_SIZE)')
+    parser.add_argument('--blocks', type=int, default=16,
+                        help='planner slots (BLOCK_BUFFER_SIZE)')
+    parser.add_argument('--move-time', type=float, default=0.01,
+                        help='execution time per move in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='probability of a checksum error per line')
+    parser.add_argument('--errors', type=lambda s: [int(n) for n in s.split(',')],
+                        default=(), help='line numbers failing their checksum')
+    parser.add_argument('--heat-time', type=float, default=1.0,
+                        help='time constant of the hotends in seconds')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='round trip time of the link in seconds')
+    args = parser.parse_args()
+    sim = Marlin(bufsize=args.bufsize, rxsize=args.rxsize, blocks=args.blocks,
+                 moveTime=args.move_time, errorRate=args.error_rate,
+                 errors=args.errors, heatTime=args.heat_time,
+                 latency=args.latency)
+    print('Simulated Marlin printer on', sim.start(), flush=True)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sim.stop()
+        print(json.dumps(sim.stats), flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module contains the transport metrics for the 3D-Gui program.
+
+When data.metrics is set the transport records, per numbered line, the
+time it was sent and the time Marlin acknowledged it, samples the B and
+P words of every ADVANCED_OK reply and counts frames, bytes, writes, oks
+and resends. All storage is allocated up front in fixed-size arrays, so
+the bookkeeping per line is a few index operations. Without data.metrics the
+transport holds None and pays for a single test per call.
+
+The send-to-ok latencies go into an HDR style histogram: values are
+kept in microseconds in log-linear buckets, 32 per power of two, which
+bounds the error of any percentile to about 3% at constant memory.
+"""
+import time
+from array import array
+
+SUBBITS = 5             # log2 of the sub-buckets per power of two
+SUB = 1 << SUBBITS
+MAXBITS = 36            # values up to 2**36 us (19 hours) are tracked
+
+
+class Histogram():
+    ''' Log-linear histogram of non-negative integers.'''
+
+    def __init__(self):
+        self.counts = array('Q', bytes(8 * SUB * (MAXBITS - SUBBITS + 1)))
+        self.total = 0
+        self.sum = 0
+        self.max = 0
+
+    @staticmethod
+    def _index(value):
+        if value < 2 * SUB:
+            return value
+        shift = value.bit_length() - SUBBITS - 1
+        return SUB * shift + (value >> shift)
+
+    @staticmethod
+    def _value(index):
+        ''' Lowest value counted in bucket index.'''
+        if index < 2 * SUB:
+            return index
+        shift = index // SUB - 1
+        return (index % SUB + SUB) << shift
+
+    def record(self, value):
+        value = min(int(value), (1 << MAXBITS) - 1)
+        self.counts[self._index(value)] += 1
+        self.total += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        ''' Value below which p percent of the recorded values fall.'''
+        if not self.total:
+            return 0
+        rank = max(1, round(self.total * p / 100))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self._value(index), self.max)
+        return self.max
+
+    def mean(self):
+        return self.sum / self.total if self.total else 0
+
+    def reset(self):
+        self.__init__()
+
+
+class Metrics():
+    ''' Transport instrumentation. depth must be a power of two larger
+        than the number of lines ever in flight; samples is the number
+        of B/P samples kept (the oldest are overwritten).
+    '''
+
+    def __init__(self, depth=1024, samples=4096):
+        self.mask = depth - 1
+        self.sendTime = array('d', bytes(8 * depth))  # by lineno & mask
+        self.sendLine = array('q', [-1]) * depth     # lineno in each slot
+        self.samples = samples
+        self.sampleTime = array('d', bytes(8 * samples))
+        self.sampleB = array('H', bytes(2 * samples))
+        self.sampleP = array('H', bytes(2 * samples))
+        self.latency = Histogram()  # send-to-ok times in microseconds
+        self.reset()
+
+    def reset(self):
+        ''' Start over, e.g. for a new job.'''
+        self.start = time.perf_counter()
+        self.lastAck = -1
+        self.sampleCount = 0
+        self.counters = dict.fromkeys(('frames', 'bytes', 'writes', 'oks',
+                                       'resends', 'replayed'), 0)
+        self.latency.reset()
+
+    def sent(self, lineno, size):
+        ''' A frame of size bytes has been committed to the link.'''
+        self.counters['frames'] += 1
+        self.counters['bytes'] += size
+        if lineno > 0:
+            i = lineno & self.mask
+            self.sendTime[i] = time.perf_counter()
+            self.sendLine[i] = lineno
+
+    def acked(self, lineno, B, P):
+        ''' Marlin replied "ok N<lineno> P<P> B<B>".'''
+        now = time.perf_counter()
+        self.counters['oks'] += 1
+        for n in range(max(self.lastAck + 1, lineno - self.mask), lineno + 1):
+            i = n & self.mask
+            if self.sendLine[i] == n:
+                self.latency.record(1e6 * (now - self.sendTime[i]))
+                self.sendLine[i] = -1
+        self.lastAck = lineno
+        i = self.sampleCount % self.samples
+        self.sampleTime[i] = now - self.start
+        self.sampleB[i] = B
+        self.sampleP[i] = P
+        self.sampleCount += 1
+
+    def count(self, counter, n=1):
+        self.counters[counter] += n
+
+    def series(self):
+        ''' The B/P samples kept, oldest first, as (times, B, P) lists.'''
+        n = min(self.sampleCount, self.samples)
+        first = self.sampleCount - n
+        order = [(first + k) % self.samples for k in range(n)]
+        return ([self.sampleTime[i] for i in order],
+                [self.sampleB[i] for i in order],
+                [self.sampleP[i] for i in order])
+
+    def snapshot(self):
+        ''' Counters and latency percentiles (in ms) as a dict.'''
+        elapsed = time.perf_counter() - self.start
+        times, B, P = self.series()
+        result = dict(self.counters)
+        result.update({
+            'seconds': elapsed,
+            'lines/s': self.counters['frames'] / elapsed if elapsed else 0,
+            'latency ms mean': self.latency.mean() / 1000,
+            'latency ms max': self.latency.max / 1000,
+            'B mean': sum(B) / len(B) if B else 0,
+            'P min': min(P, default=0)})
+        for p in (50, 90, 99, 99.9):
+            result['latency ms p{:g}'.format(p)] = self.latency.percentile(p) / 1000
+        return result
+
+    def report(self):
+        ''' Snapshot formatted for a text panel.'''
+        s = self.snapshot()
+        return ('{frames} lines, {bytes} bytes, {writes} writes in {seconds:.1f}s '
+                '({lines/s:.0f} lines/s), {resends} resend requests\n'
+                'send-to-ok ms: p50 {latency ms p50:.2f} p90 {latency ms p90:.2f} '
+                'p99 {latency ms p99:.2f} max {latency ms max:.2f}\n'
+                'free buffers B: mean {B mean:.1f}, free planner P: min {P min}\n'
+                .format(**s))
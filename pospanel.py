@@ -16,6 +16,7 @@ class Pospanel(ttk.Frame):
         ttk.Frame.__init__(self, master)
         self.master = master
         self.selectedAxisBtn = None   # selected axis button (!)
+        self.shown = {}     # button: (text, style) shown now
         
         self.xbtn = ttk.Button(self, text='X: ', style ='Unhomed.Axis.TButton',
                               command =lambda: self._select(self.xbtn))
@@ -51,22 +52,17 @@ class Pospanel(ttk.Frame):
         self.style.configure('Extr.Axis.TButton', # smaller font for extruders
             width=3, font=('Helvetica', 12, 'bold'))
         
-    def update(self, pos):
-        ''' Update the values (pos=[x,y,z,e0,e1]).'''
-        x,y,z,e = pos[0:4:]
-        self.xbtn.configure(text='X: {:>-8.2f}'.format(x))
-        self.ybtn.configure(text='Y: {:>-8.2f}'.format(y))
-        self.zbtn.configure(text='Z: {:>-8.2f}'.format(z))
-        self.ebtn.configure(text='E: {:>-8.2f}'.format(e))
-        self.xbtn.configure(style='Homed.Axis.TButton'
-                            if 'X' in data.homed 
-                            else 'Unhomed.Axis.TButton')
-        self.ybtn.configure(style='Homed.Axis.TButton'
-                            if 'Y' in data.homed 
-                            else 'Unhomed.Axis.TButton')
-        self.zbtn.configure(style='Homed.Axis.TButton'
-                            if 'Z' in data.homed 
-                            else 'Unhomed.Axis.TButton')
+    def update(self, state):
+        ''' Update the values from a data.state snapshot.'''
+        x,y,z,e = state.pos[0:4:]
+        for btn, axis, value in ((self.xbtn, 'X', x), (self.ybtn, 'Y', y),
+                                 (self.zbtn, 'Z', z), (self.ebtn, 'E', e)):
+            text = '{}: {:>-8.2f}'.format(axis, value)
+            style = 'Unhomed.Axis.TButton' if axis in 'XYZ' and \
+                    axis not in state.homed else 'Homed.Axis.TButton'
+            if self.shown.get(btn) != (text, style):  # touch changed buttons only
+                self.shown[btn] = (text, style)
+                btn.configure(text=text, style=style)
   
     def getAxis(self, btn):
         ''' Convert axis button to index for global use.'''
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module contains resume-from-line for the 3D-Gui program.
+
+To restart a failed print at a layer or line, the machine has to be put
+into the modal state the job would have built up by then: temperatures,
+fan, active tool, G90/G91, M82/M83, the E position (G92 E) and the
+position of the nozzle. The background analysis (see analysis) folds the
+rows of every tokenizer chunk into a Machine state and keeps the state
+at the start of each chunk as a checkpoint. locate() takes the nearest
+checkpoint before a line and tokenizes only the lines from there (at
+most one chunk), so resuming deep into a large file does not re-read it.
+prologue() turns a Machine into the commands sent before the job. With
+arcs fitted (see arcfit), a line inside an arc resumes at the start of
+the arc (runStart).
+
+The printer must still know its Z position (no power loss): the prologue
+lifts the nozzle off the part, homes X and Y only, moves over the resume
+point and lowers it to the Z of the job.
+"""
+import bisect
+from collections import namedtuple
+
+import numpy as np
+
+import tokenizer
+
+Machine = namedtuple('Machine', [
+    'line',     # the state before this source line
+    'pos',      # X Y Z E
+    'absolute', # G90 in effect
+    'relE',     # E relative (M83 or G91, see tokenizer)
+    'feed',     # last F, mm/min (None: none yet)
+    'tool',     # active tool
+    'hotends',  # ((tool, set point), ..) as last set
+    'bed',      # bed set point
+    'fan',      # fan speed 0-255
+    ])
+
+
+def initial():
+    ''' The state at the start of a job.'''
+    return Machine(0, (0., 0., 0., 0.), True, False, None, 0, (), 0., 0.)
+
+
+def _last(values, mask):
+    ''' The last of values where mask is set, None if there is none.'''
+    where = np.flatnonzero(mask)
+    return values[where[-1]] if len(where) else None
+
+
+def fold(machine, rows, pos, line):
+    ''' The state after rows, starting from machine; pos is the position
+        after the last row, line the next source line.
+    '''
+    cmd, code = rows['cmd'], rows['code']
+    m = cmd == b'M'
+    feed = _last(rows['F'], ~np.isnan(rows['F']))
+
+    toolRows = np.flatnonzero(cmd == b'T')
+    tool = machine.tool if not len(toolRows) else int(code[toolRows[-1]])
+    hotends = dict(machine.hotends)
+    heat = np.flatnonzero(m & ((code == 104) | (code == 109)) & ~np.isnan(rows['S']))
+    if len(heat):
+        # the tool a temperature is for: T parameter, else the active tool
+        active = np.append(machine.tool, code[toolRows])[np.searchsorted(toolRows, heat)]
+        target = np.where(np.isnan(rows['T'][heat]), active, rows['T'][heat])
+        for t, s in zip(target.astype(int).tolist(), rows['S'][heat].tolist()):
+            hotends[t] = s
+    bed = _last(rows['S'], m & ((code == 140) | (code == 190)) & ~np.isnan(rows['S']))
+    fans = np.flatnonzero(m & ((code == 106) | (code == 107)))
+    fan = machine.fan
+    if len(fans):
+        last = rows[fans[-1]]
+        fan = 0. if last['code'] == 107 else (255. if np.isnan(last['S']) else last['S'])
+    return Machine(line, tuple(float(p) for p in pos),
+                   bool(rows['absolute'][-1]) if len(rows) else machine.absolute,
+                   bool(rows['relE'][-1]) if len(rows) else machine.relE,
+                   machine.feed if feed is None else float(feed),
+                   tool, tuple(sorted(hotends.items())),
+                   machine.bed if bed is None else float(bed), float(fan))
+
+
+def runStart(arcs, line):
+    ''' The first line of the arc of arcfit.Arcs arcs that source line
+        line lies in, line if it is in none (or arcs is None). An arc is
+        sent as a single frame, so a print can only resume at its start.
+    '''
+    if not arcs or not arcs.runs:
+        return line
+    firsts = sorted(arcs.runs)
+    index = bisect.bisect_right(firsts, line) - 1
+    if index >= 0 and arcs.runs[firsts[index]][0] >= line:
+        return firsts[index]
+    return line
+
+
+def locate(job, checkpoints, line):
+    ''' The Machine state before source line line of Jobfile job, from
+        the list of checkpoints (Machine states, by line) of its analysis.
+    '''
+    index = bisect.bisect_right([c.line for c in checkpoints], line) - 1
+    machine = checkpoints[index] if index >= 0 else initial()
+    modes = [machine.absolute, machine.relE]
+    rows = tokenizer.span(job, machine.line, line, modes)
+    pos = np.array(machine.pos)
+    tokenizer.positions(rows, pos)
+    return fold(machine, rows, pos, line)
+
+
+def prologue(machine, lift=5., travel=6000.):
+    ''' The commands that restore the state machine: heat up, lift by
+        lift mm, home X and Y and move over the resume point at travel
+        mm/min, lower the nozzle, then set the modes, E and the fan.
+    '''
+    x, y, z, e = machine.pos
+    commands = []
+    if machine.bed:
+        commands.append('M140 S{:g}'.format(machine.bed))
+    hotends = [(t, s) for t, s in machine.hotends if s]
+    for t, s in hotends:
+        commands.append('M104 T{} S{:g}'.format(t, s))
+    if machine.bed:
+        commands.append('M190 S{:g}'.format(machine.bed))
+    for t, s in hotends:
+        commands.append('M109 T{} S{:g}'.format(t, s))
+    commands += ['T{}'.format(machine.tool),
+                 'G91',     # off the part before homing
+                 'G1 Z{:g} F600'.format(lift),
+                 'G90',
+                 'G28 X Y',
+                 'G1 X{:.3f} Y{:.3f} F{:g}'.format(x, y, travel),
+                 'G1 Z{:.3f} F600'.format(z)]
+    if not machine.absolute:    # G91 makes E relative too: set E after it
+        commands.append('G91')
+    commands += ['M83' if machine.relE else 'M82',
+                 'G92 E{:.5f}'.format(e),
+                 'M106 S{:g}'.format(machine.fan) if machine.fan else 'M107']
+    if machine.feed:
+        commands.append('G1 F{:g}'.format(machine.feed))
+    return commands
+
+
+def firstFrame(job, line):
+    ''' Index of the first frame of Compiledjob job at or after source
+        line line.
+    '''
+    return int(np.searchsorted(np.asarray(job.srcLine), line))
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module contains the printer state store for the 3D-Gui program.
+
+The state the decoder learns from the printer (positions, temperatures,
+ready, ...) is written by the decoder thread and read by the Tk thread.
+Instead of mutating shared globals in place, every change publishes a
+new immutable State snapshot by swapping a single reference, and each
+snapshot carries a sequence number. Readers call get() and work on the
+snapshot they got: they never take a lock and never see a half-updated
+temperature pair. Writers serialise on a lock so read-modify-write
+changes do not get lost.
+"""
+import threading
+from collections import namedtuple
+from types import MappingProxyType
+
+Temp = namedtuple('Temp', 'PV SP')     # process value, set point
+
+State = namedtuple('State', [
+    'seq',      # sequence number, incremented by every change
+    'pos',      # (X, Y, Z, E) reported positions
+    'tmp',      # read-only mapping 'T0:', 'T1:', 'B:' -> Temp
+    'ready',    # printer reported ready
+    'homed',    # frozenset of axes that have been homed
+    'extruder', # active extruder reported
+    ])
+
+
+def initial():
+    ''' The state before anything has been heard from the printer.'''
+    return State(seq=0, pos=(0., 0., 0., 0.),
+                 tmp=MappingProxyType({key: Temp(-1, -1)
+                                       for key in ('T0:', 'T1:', 'B:')}),
+                 ready=False, homed=frozenset(), extruder=0)
+
+
+class StateStore():
+    ''' Publishes immutable State snapshots.'''
+
+    def __init__(self):
+        self._state = initial()
+        self._lock = threading.Lock()   # taken by writers only
+
+    def get(self):
+        ''' The current snapshot.'''
+        return self._state
+
+    def set(self, **changes):
+        ''' Publish a snapshot with the fields in changes replaced.
+            Nothing is published if the values are the ones known.
+        '''
+        with self._lock:
+            state = self._state
+            for field, value in changes.items():
+                if getattr(state, field) != value:
+                    self._state = state._replace(seq=state.seq + 1, **changes)
+                    return
+
+    def change(self, function):
+        ''' Publish a snapshot with the fields returned (as a dict) by
+            function(current snapshot) replaced. Use this when the new
+            value depends on the current one.
+        '''
+        with self._lock:
+            self._state = self._state._replace(seq=self._state.seq + 1,
+                                               **function(self._state))
+
+    # setPos() and setTemps() get a report each, so they build the State
+    # from its fields in order rather than with the slower _replace().
+
+    def setPos(self, pos):
+        ''' Update the positions to the tuple pos.'''
+        with self._lock:
+            state = self._state
+            if pos != state.pos:
+                self._state = State(state.seq + 1, pos, *state[2:])
+
+    def setTemps(self, temps):
+        ''' Update the Temp entries from the dict temps of (PV, SP)
+            pairs; a PV or SP of None keeps the value known.
+        '''
+        with self._lock:
+            state = self._state
+            tmp = None
+            for key, (PV, SP) in temps.items():
+                old = state.tmp[key]
+                PV = old.PV if PV is None else PV
+                SP = old.SP if SP is None else SP
+                if PV != old.PV or SP != old.SP:
+                    if tmp is None:
+                        tmp = dict(state.tmp)
+                    tmp[key] = Temp(PV, SP)
+            if tmp is not None:
+                self._state = State(state.seq + 1, state.pos,
+                                    MappingProxyType(tmp), *state[3:])
+
+    def home(self, axis):
+        ''' Mark axis as homed.'''
+        self.change(lambda state: {'homed': state.homed | {axis}})
+
+    def reset(self):
+        ''' Back to the initial state, e.g. after a disconnect.'''
+        with self._lock:
+            self._state = initial()._replace(seq=self._state.seq + 1)
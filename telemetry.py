@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module contains the telemetry store for the 3D-Gui program.
+
+The temperature and position reports decoded are recorded as rows of
+CHANNELS (PV and SP of both hotends and the bed, X, Y, Z and E) with
+their time stamp, at most one per data.recordInterval (see data.record).
+Rows go into a tier of preallocated NumPy ring buffers:
+    raw     every row recorded
+    10s     means over 10 second buckets
+    1min    means over 1 minute buckets
+The means are taken over the raw rows of a bucket once it is complete,
+and raw rows are written in batches, so recording a report mostly just
+appends it to a list. Each tier keeps a fixed number of rows, so memory
+stays bounded however long the program runs; with the default sizes the
+raw tier covers hours, the 10s tier a day and the 1min tier a week.
+query() picks the finest tier that still reaches back to the start of
+the requested range.
+save() writes all tiers to a compressed .npz file, load() reads it back.
+"""
+import threading
+import time
+
+import numpy as np
+
+CHANNELS = ('T0 PV', 'T0 SP', 'T1 PV', 'T1 SP', 'B PV', 'B SP',
+            'X', 'Y', 'Z', 'E')
+PENDING = 256           # rows added before they are written to a tier
+
+
+class Tier():
+    ''' Ring buffer of rows. Rows added are collected in a list and
+        written to the buffer PENDING at a time, or by flush().
+    '''
+
+    def __init__(self, name, capacity):
+        self.name = name
+        self.capacity = capacity
+        self.times = np.zeros(capacity)
+        self.values = np.zeros((capacity, len(CHANNELS)))
+        self.count = 0              # rows ever written
+        self.pending = []           # (t, *row) not written yet
+
+    def add(self, t, row):
+        self.pending.append((t,) + row)
+        if len(self.pending) >= PENDING:
+            self.flush()
+
+    def flush(self):
+        ''' Write the pending rows to the buffer.'''
+        if not self.pending:
+            return
+        end = self.count + len(self.pending)
+        rows = np.array(self.pending[-self.capacity:])
+        i = np.arange(end - len(rows), end) % self.capacity
+        self.times[i] = rows[:, 0]
+        self.values[i] = rows[:, 1:]
+        self.count = end
+        self.pending = []
+
+    def since(self, first, end):
+        ''' Values of the rows written first..end-1 still kept.'''
+        first = max(first, end - self.capacity)
+        return self.values[np.arange(first, end) % self.capacity]
+
+    def _put(self, t, row):
+        i = self.count % self.capacity
+        self.times[i] = t
+        self.values[i] = row
+        self.count += 1
+
+    def ordered(self):
+        ''' Times and values kept, oldest first (copies).'''
+        if self.count <= self.capacity:
+            return self.times[:self.count].copy(), self.values[:self.count].copy()
+        i = self.count % self.capacity
+        return (np.concatenate((self.times[i:], self.times[:i])),
+                np.concatenate((self.values[i:], self.values[:i])))
+
+    def between(self, start=None, end=None):
+        ''' Times and values from start to end (None: unbounded), oldest
+            first. Only the rows in the range are copied.
+        '''
+        if self.count <= self.capacity:
+            parts = [(self.times[:self.count], self.values[:self.count])]
+        else:   # two sorted runs: the older one after the write index
+            i = self.count % self.capacity
+            parts = [(self.times[i:], self.values[i:]), (self.times[:i], self.values[:i])]
+        times, values = [], []
+        for t, v in parts:
+            lo = 0 if start is None else np.searchsorted(t, start)
+            hi = len(t) if end is None else np.searchsorted(t, end, 'right')
+            times.append(t[lo:hi])
+            values.append(v[lo:hi])
+        return np.concatenate(times), np.concatenate(values)
+
+    def oldest(self):
+        ''' Time of the oldest row kept.'''
+        if not self.count:
+            return None
+        return self.times[self.count % self.capacity if self.count > self.capacity else 0]
+
+
+class Means(Tier):
+    ''' Ring buffer of the means of the rows of the Tier source over
+        buckets of period seconds. A bucket is averaged in one go when
+        the first row of the next one arrives, over the rows of it that
+        source still keeps.
+    '''
+
+    def __init__(self, name, period, capacity, source):
+        super().__init__(name, capacity)
+        self.period = period        # bucket length in seconds
+        self.source = source
+        self.bucket = np.inf        # start time of the bucket being filled
+        self.end = -np.inf          # and its end
+        self.first = 0              # first row of source in the bucket
+
+    def add(self, t, row):
+        if self.bucket <= t < self.end:
+            return
+        self.source.flush()
+        end = self.source.count - 1     # row t opens the new bucket
+        if self.bucket != np.inf and end > self.first:
+            self._put(self.bucket, self.source.since(self.first, end).mean(0))
+        self.bucket = t - t % self.period
+        self.end, self.first = self.bucket + self.period, end
+
+
+class Telemetry():
+    ''' The time series store, fed by the decoder.'''
+
+    def __init__(self, raw=16384, tenSeconds=8640, oneMinute=10080):
+        self.raw = Tier('raw', raw)
+        self.tiers = [self.raw,
+                      Means('10s', 10, tenSeconds, self.raw),
+                      Means('1min', 60, oneMinute, self.raw)]
+        self.lock = threading.Lock()
+
+    def record(self, state, t=None):
+        ''' Record the temperatures and positions of a data.state
+            snapshot, at time t (default: now).
+        '''
+        t = time.time() if t is None else t
+        tmp = state.tmp
+        T0, T1, B = tmp['T0:'], tmp['T1:'], tmp['B:']
+        row = (T0.PV, T0.SP, T1.PV, T1.SP, B.PV, B.SP) + state.pos
+        with self.lock:
+            for tier in self.tiers:
+                tier.add(t, row)
+
+    def query(self, start=None, end=None, channels=None, tier=None):
+        ''' Return (times, values) of the rows between start and end
+            (seconds since the epoch, None: unbounded), oldest first.
+            values has a column per channel in channels (default: all).
+            tier names the resolution; by default the finest tier that
+            holds the whole range is used.
+        '''
+        with self.lock:
+            self.raw.flush()
+            if tier is not None:
+                chosen = next(t for t in self.tiers if t.name == tier)
+            else:   # finest tier not wrapped around yet or reaching start
+                chosen = next((t for t in self.tiers if t.count <= t.capacity
+                               or start is not None and t.oldest() <= start),
+                              self.tiers[-1])
+            times, values = chosen.between(start, end)
+        if channels is not None:
+            values = values[:, [CHANNELS.index(c) for c in channels]]
+        return times, values
+
+    def save(self, filename):
+        ''' Export all tiers to the .npz file filename.'''
+        arrays = {'channels': np.array(CHANNELS)}
+        with self.lock:
+            self.raw.flush()
+            for tier in self.tiers:
+                arrays[tier.name + ' times'], arrays[tier.name + ' values'] = tier.ordered()
+        np.savez_compressed(filename, **arrays)
+
+    @staticmethod
+    def load(filename):
+        ''' Read an export back as {tier name: (times, values)}.'''
+        with np.load(filename) as f:
+            if tuple(f['channels']) != CHANNELS:
+                raise ValueError('{} holds other channels'.format(filename))
+            names = [key[:-6] for key in f.files if key.endswith(' times')]
+            return {name: (f[name + ' times'], f[name + ' values']) for name in names}
@@ -22,6 +22,7 @@ class Temppanel(ttk.Frame):
         self.tol = 2        # tolerance within which the LED turns on
         self.lock = False   # avoid multiple popups
         self.gcode = gcode  # command to set SP in printer (M104 or M140)
+        self.shown = {}     # what the widgets show now, to skip redundant updates
         
         self.cv = tk.Canvas(self, width=236, height=50, 
                             bd=1, highlightt=0, bg='black')
@@ -53,6 +54,9 @@ class Temppanel(ttk.Frame):
         self.cv.itemconfig('scale', text=value)
         
     def setSP(self, value):
+        if self.shown.get('SP') == value:
+            return
+        self.shown['SP'] = value
         self.setPoint = value
         self.lb2.configure(text='Set Point: {} ⁰C'.format(value))
         pos = value*200 //self.scale
@@ -60,6 +64,9 @@ class Temppanel(ttk.Frame):
         self.setTol(self.tol)
  
     def setPV(self, value):
+        if self.shown.get('PV') == value:
+            return
+        self.shown['PV'] = value
         self.procVal = value
         self.cv.coords('bar', 3, 15, 
             min(value*200/self.scale, 200), 35)
@@ -69,9 +76,10 @@ class Temppanel(ttk.Frame):
   
     def setTol(self, value):
         self.tol = value
-        self.cv.itemconfig('led', 
-            fill='lightgreen' if abs(self.procVal - self.setPoint) < value 
-                              else 'red')
+        led = 'lightgreen' if abs(self.procVal - self.setPoint) < value else 'red'
+        if self.shown.get('led') != led:
+            self.shown['led'] = led
+            self.cv.itemconfig('led', fill=led)
     
     def setPopup(self, *args):
         ''' pop up the set temps window to set SP.'''
@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+''' Tests of the gcode file analysis (analysis.py).'''
+import pytest
+
+import analysis
+import jobfile
+
+
+def analyze(tmp_path, text):
+    name = tmp_path / 'job.gcode'
+    name.write_text(text)
+    job = jobfile.openJob(str(name))
+    try:
+        return analysis.analyze(job)
+    finally:
+        job.close()
+
+
+def test_retract_and_prime_count_once(tmp_path):
+    result = analyze(tmp_path, 'G90\nM82\nG1 X10 E5\nG1 E4\nG1 E5\nG1 X20 E10\n')
+    assert result.extrusion == pytest.approx(10)
+    assert result.bbox == ((0., 0., 0.), (20., 0., 0.))
+
+
+def test_extrusion_across_g92(tmp_path):
+    result = analyze(tmp_path, 'M83\nG1 X10 E2\nG1 E-1\nG92 E0\nG1 E1\nG1 X20 E3\n')
+    assert result.extrusion == pytest.approx(5)
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+''' Tests of the arc fitting pre-pass (arcfit.py).'''
+import math
+
+import arcfit
+import jobfile
+
+
+def circle(tmp_path, fraction, segments=64, radius=10.):
+    ''' A Jobfile tracing fraction of a circle with G1 segments.'''
+    lines = ['G90', 'M82', 'G92 E0', 'G1 X{:.3f} Y0 F1800'.format(radius)]
+    for i in range(1, int(segments * fraction) + 1):
+        a = 2 * math.pi * i / segments
+        lines.append('G1 X{:.3f} Y{:.3f} E{:.5f}'.format(
+            radius * math.cos(a), radius * math.sin(a), 0.05 * i))
+    name = tmp_path / 'circle.gcode'
+    name.write_text('\n'.join(lines) + '\n')
+    return jobfile.openJob(str(name))
+
+
+def test_closed_circle_becomes_two_arcs(tmp_path):
+    job = circle(tmp_path, 1)
+    arcs = arcfit.fit(job)
+    job.close()
+    assert len(arcs.runs) == 2
+    assert arcs.lines == 64
+    commands = [command for last, command in arcs.runs.values()]
+    assert all(c.startswith(b'G3 ') for c in commands)
+    assert commands[-1].split()[1:3] == [b'X10', b'Y0']
+    assert commands[-1].split()[-1] == b'E3.2'
+
+
+def test_open_arcs_fit_whole(tmp_path):
+    for fraction in (0.75, 0.98):
+        job = circle(tmp_path, fraction)
+        arcs = arcfit.fit(job)
+        job.close()
+        assert len(arcs.runs) == 1
+        assert arcs.lines == int(64 * fraction)
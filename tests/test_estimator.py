@@ -0,0 +1,17 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+''' Tests of the print time estimator (estimator.py).'''
+import pytest
+
+import estimator
+import jobfile
+
+
+def test_job_ends_at_standstill(tmp_path):
+    name = tmp_path / 'job.gcode'
+    name.write_text('G1 X100 F6000\n')
+    job = jobfile.openJob(str(name))
+    times = estimator.estimate(job)
+    job.close()
+    # 100 mm/s, 3000 mm/s²: accelerate and decelerate 1/30 s each
+    assert times[-1] == pytest.approx(1 + 1 / 30)
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+''' Tests of the print job compiler (jobcache.py).'''
+import gzip
+
+import jobcache
+import jobfile
+
+
+def test_damaged_artifact_is_rebuilt(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobcache, 'cacheDir', str(tmp_path / 'cache'))
+    name = tmp_path / 'job.gcode'
+    name.write_text('G28\nG1 X10 ; comment\n\nM105\n')
+    job = jobfile.openJob(str(name))
+    compiled = jobcache.load(job)
+    filename, frames = compiled.filename, [compiled.frame(i) for i in range(len(compiled))]
+    compiled.close()
+    assert frames == [b'N0 G28*19\n', b'N1 G1 X10*80\n', b'N2 M105*37\n']
+    for size in (0, 10, 40):    # empty, shorter than the trailer, truncated
+        with open(filename, 'r+b') as f:
+            f.truncate(size)
+        compiled = jobcache.load(job)
+        assert [compiled.frame(i) for i in range(len(compiled))] == frames
+        compiled.close()
+    job.close()
+
+
+def test_compressed_job_is_packed(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobcache, 'cacheDir', str(tmp_path / 'cache'))
+    monkeypatch.setattr(jobcache, 'BLOCK', 16)
+    text = ''.join('G1 X{} E{} ; move {}\n'.format(i, i / 10, i) for i in range(100))
+    plain = tmp_path / 'job.gcode'
+    plain.write_text(text)
+    packed = tmp_path / 'job.gcode.gz'
+    packed.write_bytes(gzip.compress(text.encode()))
+    frames = []
+    for name in (plain, packed):
+        job = jobfile.openJob(str(name))
+        compiled = jobcache.load(job)
+        assert compiled.packed == (name == packed)
+        frames.append([compiled.frame(i) for i in (0, 50, 99, 17, 18, 16)])
+        assert list(compiled.srcLine) == list(range(100))
+        compiled.close()
+        job.close()
+    assert frames[0] == frames[1]
+    assert frames[1][1].startswith(b'N50 G1 X50 E5.0*')
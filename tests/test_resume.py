@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+''' Tests of resume-from-line (resume.py).'''
+import math
+
+import arcfit
+import jobcache
+import jobfile
+import resume
+
+
+def openJob(tmp_path, lines):
+    name = tmp_path / 'job.gcode'
+    name.write_text('\n'.join(lines) + '\n')
+    return jobfile.openJob(str(name))
+
+
+def test_e_mode_after_g90(tmp_path):
+    job = openJob(tmp_path, ['M83', 'G1 X10 E1', 'G90', 'G1 X20 E5', 'G1 X30 E6'])
+    machine = resume.locate(job, [], 4)
+    job.close()
+    assert not machine.relE
+    assert machine.pos == (20., 0., 0., 5.)
+    commands = resume.prologue(machine)
+    modes = commands[commands.index('G90'):]    # after the lift
+    assert 'M82' in modes and 'G91' not in modes
+
+
+def test_e_mode_after_g91(tmp_path):
+    job = openJob(tmp_path, ['G91', 'G1 X10 E1', 'G1 X10 E1'])
+    machine = resume.locate(job, [], 2)
+    job.close()
+    assert machine.relE and not machine.absolute
+    commands = resume.prologue(machine)
+    modes = commands[commands.index('G90'):]    # after the lift
+    assert modes.index('G91') < modes.index('M83')
+
+
+def test_lift_before_homing():
+    machine = resume.initial()._replace(pos=(10., 20., 3., 1.))
+    commands = resume.prologue(machine, lift=5.)
+    home = commands.index('G28 X Y')
+    assert commands[home - 3:home] == ['G91', 'G1 Z5 F600', 'G90']
+    assert commands[home + 1:home + 3] == ['G1 X10.000 Y20.000 F6000', 'G1 Z3.000 F600']
+
+
+def test_resume_inside_an_arc(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobcache, 'cacheDir', str(tmp_path / 'cache'))
+    lines = ['G90', 'M82', 'G92 E0', 'G1 X20 Y0 F1800']
+    for i in range(1, 33):      # half a circle of radius 20
+        a = math.pi * i / 32
+        lines.append('G1 X{:.3f} Y{:.3f} E{:.5f}'.format(
+            20 * math.cos(a), 20 * math.sin(a), 0.05 * i))
+    lines.append('G1 X-20 Y-10 E2')
+    job = openJob(tmp_path, lines)
+    arcs = arcfit.fit(job)
+    assert arcs.runs.keys() == {4} and arcs.runs[4][0] == 35
+    assert resume.runStart(arcs, 20) == 4
+    assert resume.runStart(arcs, 4) == 4
+    assert resume.runStart(arcs, 36) == 36
+    assert resume.runStart(None, 20) == 20
+    machine = resume.locate(job, [], resume.runStart(arcs, 20))
+    assert machine.pos == (20., 0., 0., 0.)
+    compiled = jobcache.load(job, arcs=arcs)
+    frame = compiled.frame(resume.firstFrame(compiled, 4))
+    compiled.close()
+    job.close()
+    assert frame.split()[1] == b'G3'
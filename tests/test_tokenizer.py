@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+''' Tests of the vectorized gcode tokenizer (tokenizer.py).'''
+import numpy as np
+
+import tokenizer
+
+
+def tokenize(text, modes=None):
+    modes = [True, False] if modes is None else modes
+    return tokenizer.tokenize(np.frombuffer(text.encode(), np.uint8), modes)
+
+
+def test_e_mode_follows_the_last_command():
+    # G90 and M82 make E absolute, G91 and M83 relative, as in Marlin
+    rows = tokenize('M83\nG1 E1\nG90\nG1 E5\nG91\nG1 E1\nM82\nG1 E8\n'
+                    'G90\nM83\nG1 E2\n')
+    moves = rows[rows['cmd'] == b'G']
+    moves = moves[moves['code'] == 1]
+    assert moves['relE'].tolist() == [True, False, True, False, True]
+    assert moves['absolute'].tolist() == [True, True, False, False, True]
+    pos = np.zeros(4)
+    assert tokenizer.positions(moves, pos)[:, 3].tolist() == [1., 5., 6., 8., 10.]
+
+
+def test_modes_carry_across_chunks():
+    modes = [True, False]
+    tokenize('G91\n', modes)
+    assert modes == [False, True]
+    rows = tokenize('M82\nG1 E1\n', modes)
+    assert rows['relE'].tolist() == [False, False]
+    assert modes == [False, False]
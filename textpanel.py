@@ -8,14 +8,22 @@ Created on Tue Mar  1 13:51:27 2022
 import tkinter as tk
 from tkinter import ttk
 from tkinter import scrolledtext
+from collections import deque
 import data
 
 class Textpanel(ttk.Frame):
-    ''' A widget for displaying text.'''
+    ''' A widget for displaying text. show() may be called from any
+        thread: messages are queued and written to the widget in
+        batches by the Tk thread, at most once per interval ms. The
+        widget keeps the last maxLines lines only.
+    '''
     
-    def __init__(self, master, caption, h, w, sb=1):
+    def __init__(self, master, caption, h, w, sb=1, maxLines=1000, interval=100):
         ttk.Frame.__init__(self, master, height=h, width=w)
         self.master = master
+        self.maxLines = maxLines    # older lines are dropped
+        self.interval = interval    # ms between flushes
+        self.pending = deque()      # messages waiting for the Tk thread
         self.label = ttk.Label(self, text=caption)
         self.txt = tk.Text(self, height=h, width=w, wrap= 'word')
         self.sbar = tk.Scrollbar(self)
@@ -27,13 +35,29 @@ class Textpanel(ttk.Frame):
             self.sbar['command'] = self.txt.yview
             self.txt['yscrollcommand'] = self.sbar.set
         self.txt.bind('<Return>', lambda event: self.send())
+        self.after(self.interval, self._flush)
         
     def show(self, txt):
         ''' Show method is non-editable.'''
-        self.txt.configure(state='normal')
-        self.txt.insert('end', txt)
-        self.txt.see( 'end')
-        self.txt.configure(state='disabled')
+        self.pending.append(txt)
+
+    def _flush(self):
+        ''' Write the queued messages in one go (Tk thread only).'''
+        if self.pending:
+            chunks = []
+            while self.pending:     # deque pops are thread-safe
+                chunks.append(self.pending.popleft())
+            txt = ''.join(chunks)
+            if txt.count('\n') > self.maxLines:  # flood: drop what would be trimmed
+                txt = '\n'.join(txt.split('\n')[-self.maxLines - 1:])
+            self.txt.configure(state='normal')
+            self.txt.insert('end', txt)
+            lines = int(self.txt.index('end-1c').split('.')[0])
+            if lines > self.maxLines:
+                self.txt.delete('1.0', '{}.0'.format(lines - self.maxLines + 1))
+            self.txt.see( 'end')
+            self.txt.configure(state='disabled')
+        self.after(self.interval, self._flush)
 
     def send(self):
         ''' Only used in MDI panel to send text to printer.'''
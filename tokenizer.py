@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module contains the vectorized gcode tokenizer for the 3D-Gui program.
+
+parse() turns a Jobfile into NumPy structured arrays of DTYPE, one row
+per line holding a word (a letter outside of a comment):
+    line        source line index
+    cmd, code   the first G, M or T word, e.g. b'G', 1 for G1 (b'' if
+                the line has none)
+    X Y Z E F S P T I J R
+                parameter values, NaN when absent; a letter without
+                a number (G28 X) counts as 0
+    absolute    G90 in effect (G91 clears it)
+    relE        E is relative: set by M83 and G91, cleared by M82 and
+                G90, whichever came last, as in Marlin
+The file is processed in chunks of whole lines, so memory stays bounded
+whatever the file size; parse() yields one array per chunk. Nothing is
+parsed line by line in Python: comments, words and numbers are located
+with array operations over the bytes of the chunk, and numbers are built
+from their digits as exact integers divided by a power of ten, which
+gives the same floats as float() for up to 15 significant digits.
+Parameters of text commands (M117 ..) are ignored.
+
+positions() follows the modes, G92 and G28 to give the absolute X Y Z E
+after each row.
+"""
+import numpy as np
+
+PARAMS = 'XYZEFSPTIJR'
+DTYPE = np.dtype([('line', 'u4'), ('cmd', 'S1'), ('code', 'i2')]
+                 + [(p, 'f8') for p in PARAMS]
+                 + [('absolute', '?'), ('relE', '?')])
+AXES = 'XYZE'
+WIDTH = 16      # characters of a number read at once
+TEXT = (23, 28, 30, 32, 33, 117, 118, 928)     # M codes taking a string
+
+
+# character classes for _numbers: digits 0-9, DOT, MINUS, PLUS, OTHER
+DOT, MINUS, PLUS, OTHER = 10, 11, 12, 13
+CLASS = np.full(256, OTHER, np.uint8)
+CLASS[48:58] = np.arange(10)
+CLASS[46], CLASS[45], CLASS[43] = DOT, MINUS, PLUS
+# column of each parameter letter (upper and lower case), -1 for others
+COLUMN = np.full(256, -1, np.int8)
+for i, p in enumerate(PARAMS):
+    COLUMN[ord(p)] = COLUMN[ord(p.lower())] = i
+POWERS = 10.0 ** np.arange(WIDTH + 1)   # exact in binary floating point
+
+
+def tokenize(buf, modes):
+    ''' Tokenize buf (uint8 array of whole lines). modes is the list
+        [absolute, relE] at the start of buf and is updated to
+        the modes at its end. Line numbers in the result count from the
+        start of buf.
+    '''
+    n = len(buf)
+    if not n:
+        return np.zeros(0, DTYPE)
+    # the characters that matter for the structure: letters, ';' and '\n'
+    events = np.flatnonzero(((buf | 32) - 97 < 26) | (buf == 59) | (buf == 10))
+    chars = buf[events]
+    newline = chars == 10
+    semi = np.cumsum(chars == 59, dtype=np.int32)
+    atNewline = np.maximum.accumulate(np.where(newline, semi, 0))
+    line = np.cumsum(newline, dtype=np.int32)
+    word = (chars != 10) & (chars != 59) & (semi == atNewline)  # not in a comment
+    letters, letterLine = events[word], line[word]
+
+    buf = np.concatenate((buf, np.full(WIDTH + 1, 32, np.uint8)))
+    values = _numbers(CLASS[buf], letters + 1)
+    letter = buf[letters] & 0xDF            # upper case
+
+    # one row per line with words:
+    lineStart = _firsts(letterLine)
+    wordRow = np.cumsum(lineStart, dtype=np.int32) - 1
+    rows = np.zeros(np.count_nonzero(lineStart), DTYPE)
+    rows['line'] = letterLine[lineStart]
+
+    # the command: first G, M or T word of its line
+    cmd = np.flatnonzero((letter == 71) | (letter == 77) | (letter == 84))
+    cmd = cmd[_firsts(wordRow[cmd])]
+    rows['cmd'][wordRow[cmd]] = letter[cmd].view('S1')
+    rows['code'][wordRow[cmd]] = np.trunc(values[cmd]).astype(np.int16)
+
+    column = COLUMN[letter]
+    column[cmd] = -1
+    text = (rows['cmd'] == b'M') & np.isin(rows['code'], TEXT)
+    param = np.flatnonzero((column >= 0) & ~text[wordRow])
+    params = np.full((len(rows), len(PARAMS)), np.nan)
+    params[wordRow[param], column[param]] = values[param]   # the last one wins
+    for i, p in enumerate(PARAMS):
+        rows[p] = params[:, i]
+
+    _modes(rows, modes)
+    return rows
+
+
+def _firsts(keys):
+    ''' Mask of the first of each run of equal values in sorted keys.'''
+    mask = np.empty(len(keys), bool)
+    mask[:1] = True
+    np.not_equal(keys[1:], keys[:-1], out=mask[1:])
+    return mask
+
+
+def _numbers(classes, first):
+    ''' Values of the numbers starting at the indices first of the
+        character classes (0 where there is none). classes must end with
+        WIDTH + 1 OTHER.
+    '''
+    mantissa = np.zeros(len(first))    # the digits as an integer, exact below 2**53
+    fraction = np.zeros(len(first), np.int8)    # digits after the dot
+    dot = np.zeros(len(first), bool)    # dot seen
+    c = classes[first]
+    negative = c == MINUS
+    valid = c <= PLUS                   # still in the number
+    index = first + 1
+    for i in range(WIDTH):
+        if i:
+            c = classes[index]
+            index += 1
+            valid &= c <= DOT
+            if not valid.any():
+                break
+        digit = valid & (c < DOT)
+        mantissa = np.where(digit, mantissa * 10 + c, mantissa)
+        fraction += digit & dot
+        dot |= valid & (c == DOT)
+    values = mantissa / POWERS[fraction]
+    values[negative] *= -1
+    for i in np.flatnonzero(valid & (classes[index] <= DOT)):
+        number = classes[first[i]:]     # longer than WIDTH: the slow way
+        number = bytes(b'0123456789.-+'[c] for c in number[:np.argmax(number > PLUS)])
+        try:
+            values[i] = float(number)
+        except ValueError:
+            values[i] = 0.
+    return values
+
+
+def _modes(rows, modes):
+    ''' Fill in absolute and relE, carrying modes across chunks.'''
+    g = rows['cmd'] == b'G'
+    m = rows['cmd'] == b'M'
+    code = rows['code']
+    g90, g91 = g & (code == 90), g & (code == 91)
+    for k, (on, off) in enumerate(((g90, g91),
+                                   (g91 | m & (code == 83), g90 | m & (code == 82)))):
+        change = np.flatnonzero(on | off)
+        state = np.full(len(rows), modes[k])
+        if len(change):
+            latest = np.maximum.accumulate(
+                np.where(on | off, np.arange(len(rows)), -1))
+            known = latest >= 0
+            state[known] = on[latest[known]]
+            modes[k] = bool(state[-1])
+        rows['relE' if k else 'absolute'] = state
+
+
+def parse(job, chunk=1 << 20):
+    ''' Yield the rows of Jobfile job, a chunk of about chunk bytes of
+        whole lines at a time.
+    '''
+    if not len(job):
+        return
+    offsets = np.frombuffer(job.offsets, np.uint64).astype(np.int64)
+    modes = [True, False]
+    line = 0
+    while line < len(job):
+        stop = int(np.searchsorted(offsets, offsets[line] + chunk, 'right')) - 1
+        stop = min(max(stop, line + 1), len(job))
+        yield span(job, line, stop, modes)
+        line = stop
+
+
+def span(job, start, stop, modes):
+    ''' The rows of lines start up to stop of Jobfile job; modes as for
+        tokenize().
+    '''
+    if start >= stop:
+        return np.zeros(0, DTYPE)
+    rows = tokenize(np.frombuffer(job.block(start, stop), np.uint8), modes)
+    rows['line'] += start
+    return rows
+
+
+def positions(rows, pos):
+    ''' Absolute X Y Z E after each row, as an (n, 4) array. pos holds
+        the position before the first row and is updated to the one
+        after the last.
+    '''
+    g = rows['cmd'] == b'G'
+    code = rows['code']
+    move = g & (code >= 0) & (code <= 3)
+    g92 = g & (code == 92)
+    g28 = g & (code == 28)
+    homeAll = g28 & np.isnan(rows['X']) & np.isnan(rows['Y']) & np.isnan(rows['Z'])
+    result = np.empty((len(rows), 4))
+    index = np.arange(len(rows))
+    for k, axis in enumerate(AXES):
+        value = rows[axis]
+        present = ~np.isnan(value)
+        relative = rows['relE'] if axis == 'E' else ~rows['absolute']
+        delta = np.where(move & present & relative, value, 0.)
+        reset = move & present & ~relative | g92 & present
+        target = value
+        if axis != 'E':
+            home = g28 & (present | homeAll)
+            reset |= home
+            target = np.where(home, 0., value)
+        total = np.cumsum(delta)
+        latest = np.maximum.accumulate(np.where(reset, index, -1))
+        base = np.where(latest >= 0, (target - total)[latest], pos[k])
+        result[:, k] = base + total
+        if len(rows):
+            pos[k] = result[-1, k]
+    return result
@@ -7,29 +7,93 @@ import queue
 import threading
 import re
 import time
+from collections import deque
+from itertools import islice
 from functools import reduce
 from serial import Serial, SerialException, PARITY_ODD, PARITY_NONE
 
 import data
+import jobcache
+import resume
+from metrics import Metrics
+from underrun import UnderrunDetector
+
+class History():
+    ''' Resend history: a ring buffer holding the most recently sent
+        frames, indexed by line number. Marlin only requests resends of
+        lines still in flight, so the capacity follows the in-flight 
+        depth observed (see reserve()) rather than the job size.
+    '''
+    
+    def __init__(self, capacity = 64):
+        self.capacity = capacity
+        self.frames = [None] * capacity
+        self.lines = [-1] * capacity    # line number held by each slot
+
+    def put(self, lineno, frame):
+        i = lineno % self.capacity
+        self.frames[i] = frame
+        self.lines[i] = lineno
+
+    def get(self, lineno):
+        ''' Return the frame sent as line lineno or None if the line
+            is outside the window kept.
+        '''
+        i = lineno % self.capacity
+        return self.frames[i] if self.lines[i] == lineno else None
+
+    def window(self):
+        ''' Lowest and highest line number in the history.'''
+        kept = [n for n in self.lines if n >= 0]
+        return (min(kept), max(kept)) if kept else (-1, -1)
+
+    def reserve(self, depth):
+        ''' Grow (keeping the contents) so at least 4 times depth lines
+            are kept.
+        '''
+        if 4 * depth <= self.capacity:
+            return
+        old = [(n, f) for n, f in zip(self.lines, self.frames) if n >= 0]
+        self.__init__(1 << (4 * depth - 1).bit_length())
+        for lineno, frame in old:
+            self.put(lineno, frame)
 
 class Transport():
     
     def __init__(self, status=None):
-        self.BUFSIZE = 128      # Marlin config setting
+        self.BUFSIZE = 128      # Marlin config setting (RX_BUFFER_SIZE)
+        self.charCounting = data.flowControl == 'chars'
         self.status = status    # status panel we report to
         self.resendFrom = -1    # resend request pending if > linenumber
-        self.resending = False  # tells listen thread to ignore subsequent resend requests
+        self.replayFrom = 0     # resend window being replayed:
+        self.replayEnd = 0      #   lines replayFrom..replayEnd-1
+        self.incident = None    # resend incident being recovered (see _resendRequest)
+        self.resendLog = []     # recovered incidents: line, lines, requests, duration
         self.linenum = -1       # Nxx of current gcode line being printed
-        self.gcode = []         # entire gcode file
-        self.queueindex = 0     # index into gcode array; points to next cmd
+        self.job = None         # compiled gcode job (pre-framed lines)
+        self.queueindex = 0     # index into job frames; points to next cmd
         self.maxIndex = 0       # limit for queueindex
-        self.sentLines = {}     # command history (used for resending)
+        self.prologue = deque() # commands to send before the job (see resume)
+        self.sentLines = History()  # command history (used for resending)
         self.P_word = 0
         self.pending = 0        # number of commands sent but not yet ACK'ed
         self.lastLineSent = 0   # line number of last line sent
         self.lastLineAck  = 0   # line number for which marlin last sent an Ok (P-word in ok)
         self.buffAvailable = 5  # number of free line buffers in Marlin (B-word in ok response)
+        self.inFlight = deque() # sizes of the frames sent but not yet ACK'ed
+        self.bytesInFlight = 0  # sum of inFlight
+        self.txBuf = bytearray(4096)    # frames written at once while printing
+        self.txView = memoryview(self.txBuf)
+        self.coalesce = True    # batch frames into one write (see _batch)
+        self.held = None        # prio item taken but not sent yet (see _batch)
+        self.metrics = Metrics() if data.metrics else None  # instrumentation
+        self.underruns = UnderrunDetector() # planner running empty while printing
+        self.cmdSlots = 1       # size of Marlin's command queue (max B-word seen)
         
+        self.flow = threading.Condition()  # signals free buffers in Marlin
+        self.rxBuf = bytearray()    # receive buffer; holds incomplete lines
+        self.resendExp = re.compile(r"(\d*)$")
+        self.okExp = re.compile(r"ok N(\d+) P(\d+) B(\d+)\n")
         self.prioQ = queue.Queue()  # priority queue for immediate commands
         self.rcvr = None     # thread: listens to the printer
         self.xmtr = None     # thread: xmtr when not printing
@@ -44,7 +108,8 @@ class Transport():
     def listen(self):
         ''' This is the receiver thread. It listens to the serial port
             and handles all incoming messages. Synchronization with the
-            other program compoments occurs via two vars:
+            other program compoments occurs via two vars, both guarded
+            by the flow condition:
                 pending     number of commands issued to Marlin's.
                             Pending is incremented upon transmission of
                             a command. It is decremented upon reception
@@ -54,73 +119,214 @@ class Transport():
                             N-word and lastLineAck; because if the N-word
                             of the ok-response minus the current value of
                             lastLineAck is > 1 we must have missed an Ok.
-                resendFrom  linenumber (also index in thegcode array)
+                            The sizes of the oldest frames exceeding 
+                            pending are released from bytesInFlight.
+                resendFrom  linenumber (also index in the job frames)
                             of the command that has to be resent.
+            Every ok notifies the flow condition so a sender waiting for
+            a free buffer wakes up as soon as Marlin has one.
+            The port is read in bulk into a reusable buffer; complete
+            lines are decoded tolerantly and passed on to _dispatch().
             This thread is invoked as soon as the connection to the
             printer has been established - by connect().
         '''
         print("Starting receiver thread")
-        resendExp = re.compile("(\d*)$")
+        del self.rxBuf[:]
         
         # thread loop starts here:
         while not self.stop_rcvr:
-            if not self.printer.in_waiting:
-                continue
-            line = self.printer.readline().decode("ascii")
-            # => resend:
-            if not self.resending and line.lower().startswith(("resend", "rs")):
-                self.resendFrom = int(re.search(resendExp, line).group(1))
-            # => ok:
-            if line.startswith("ok"): 
-                m = re.search("ok N(\d+) P(\d+) B(\d+)\n", line)
+            # block (up to the port timeout) for at least one byte, then
+            # take whatever else has arrived in the same call:
+            try:
+                chunk = self.printer.read(self.printer.in_waiting or 1)
+            except SerialException as e:
+                print("Receiver:", e)
+                break
+            if chunk:
+                self._receive(chunk)
+        print("Receiver thread killed")
+
+    def _receive(self, chunk):
+        ''' Append chunk to the receive buffer and dispatch all complete
+            lines; the tail stays in the buffer.
+        '''
+        rxBuf = self.rxBuf
+        rxBuf += chunk
+        start = 0
+        with memoryview(rxBuf) as view:
+            end = rxBuf.find(b"\n")
+            while end >= 0:
+                self._dispatch(str(view[start:end+1], "ascii", "replace"))
+                start = end + 1
+                end = rxBuf.find(b"\n", start)
+        del rxBuf[:start]
+
+    def _dispatch(self, line):
+        ''' Handle a single line received from the printer: update the
+            flow control state on resend and ok responses and hand
+            everything else over to the decoder.
+        '''
+        # => resend:
+        if line.lower().startswith(("resend", "rs")):
+            self._resendRequest(int(self.resendExp.search(line).group(1)))
+        # => ok:
+        if line.startswith("ok"): 
+            m = self.okExp.search(line)
+            with self.flow:
                 # this requires ADVANCED_OK in Marlin
                 if m:   # all three of N, P and B words match:
                     N_word = int(m.group(1))        # line number of last acknowledge
                     self.P_word = int(m.group(2))   # free space in plan buffer
                     self.buffAvailable = int(m.group(3)) # number of free input buffers
+                    self.cmdSlots = max(self.cmdSlots, self.buffAvailable)
                     self.pending = max(0,self.lastLineSent - N_word)
                     self.lastLineAck = N_word
+                    if self.metrics:
+                        self.metrics.acked(N_word, self.buffAvailable, self.P_word)
+                    if self.printing and not self.incident:
+                        self.underruns.check(self.P_word, N_word, self.lastLineSent)
+                    if self.incident and self.incident['end'] is not None \
+                       and N_word >= self.incident['end'] - 1:
+                        self._resendRecovered()
                 else:   # no N_word; decrement pending for each ok received
                     # NOTE: a resend request is followed by a single ok without N, B and P.
                     # so we need this part also when no "smart" buffer mgmt would be used
                     self.pending = max(0, self.pending - 1)
-            # => info, busy, error, etc:
-            if not line.startswith("ok") or "T0:" in line:
-                data.rcvQ.put(line)
-        print("Receiver thread killed")
+                while len(self.inFlight) > self.pending:   # release bytes
+                    self.bytesInFlight -= self.inFlight.popleft()
+                self._notify()  # wake up senders waiting for buffers
+        # => info, busy, error, etc:
+        if not line.startswith("ok") or "T0:" in line:
+            self._deliver(line)
+
+    def _notify(self):
+        ''' Signal a change of the flow control state. Call with flow held.'''
+        self.flow.notify_all()
+
+    def _deliver(self, line):
+        ''' Pass a message on to the decoder.'''
+        data.rcvQ.put(line)
+
+    def _resendRequest(self, lineno):
+        ''' Handle a resend request from Marlin. After an error Marlin
+            rejects every line that was already on its way and repeats
+            the request for each of them. These duplicates are swallowed:
+            when the replay starts (_nextFrame) 'stale' is set to the
+            number of lines sent after the one requested, and only 
+            requests beyond that many count as new. Called by listen.
+        '''
+        with self.flow:
+            if self.metrics:
+                self.metrics.count('resends')
+            inc = self.incident
+            if inc and lineno == inc['line'] and \
+               (inc['stale'] is None or inc['requests'] <= inc['stale']):
+                inc['requests'] += 1    # duplicate
+                return
+            if not inc:     # a new incident starts
+                inc = self.incident = {'line': lineno, 'lines': 0, 
+                                       'requests': 0, 'stale': None,
+                                       'end': None, 
+                                       'start': time.perf_counter()}
+            inc['line'] = lineno
+            inc['requests'] = 1
+            inc['stale'] = None
+            self.resendFrom = lineno
+            self._notify()
+
+    def _resendRecovered(self):
+        ''' Marlin acknowledged the last line of the replayed window:
+            log the incident. Call with flow held.
+        '''
+        inc = self.incident
+        self.resendLog.append({'line': inc['line'], 'lines': inc['lines'],
+                               'requests': inc['requests'],
+                               'duration': time.perf_counter() - inc['start']})
+        self.incident = None
 
-    def start_print(self):
+    def start_print(self, line = 0, prologue = ()):
         ''' Setup things so the print thread can take over. Called from the 
-            print button in de gui.
+            print button in de gui. To resume a print, line is the source
+            line to start at and prologue the commands restoring the
+            machine state (see resume); they are numbered just before it.
         '''
-        if not(data.gcodeFile and data.ready and not self.printing):
+        if not self._loadJob():
             return False
-        data.gcodeFile.seek(0)
-        self.gcode = []
-        self.gcode = data.gcodeFile.readlines() # <TODO> try reading line by line?
-        if not self.gcode:  # no data in file
-            self.status.show("*** gcode file is empty")
+        first = self._firstFrame(line)
+        if first is None:
             return False
-        while not self._send("M110", -1, True):   # reset line number
-            time.sleep(0.001)
-        self.maxIndex = len(self.gcode)
-        self.linenum = 0
-        self.resendFrom = -1
-        self.resending = False
-        self.queueindex = 0
-        self.pending = 0
+        if not self._send("M110", first - len(prologue) - 1, True,   # reset line number
+                          cancelled = lambda: self.stop_rcvr):
+            self._closeJob()
+            return False
+        self._resetPrint(first, prologue)
         self.printing = True   # release the print thread
         self.print_thread = threading.Thread(target = self.print, name = "print_thread")
         self.print_thread.start()
         return True
         
+    def _loadJob(self):
+        ''' Load (compile if needed) the job for data.gcodeFile. Returns
+            False if there is nothing to print.
+        '''
+        if not(data.gcodeFile and data.state.get().ready and not self.printing):
+            return False
+        self._closeJob()
+        arcs = data.analysis.arcs if data.analysis else None
+        self.job = jobcache.load(data.gcodeFile, self.status, arcs)
+        if not len(self.job):  # no commands in file
+            self.status.show("*** gcode file is empty")
+            self._closeJob()
+            return False
+        return True
+
+    def _firstFrame(self, line):
+        ''' The frame to start the loaded job at for source line line,
+            None (and the job closed) if nothing follows.
+        '''
+        first = resume.firstFrame(self.job, line)
+        if first >= len(self.job):
+            self.status.show("*** nothing to print from line {}\n".format(line + 1))
+            self._closeJob()
+            return None
+        return first
+
+    def _resetPrint(self, first = 0, prologue = ()):
+        ''' Reset the print state for a new job starting at frame first,
+            preceded by the commands prologue.
+        '''
+        self.maxIndex = len(self.job)
+        self.linenum = first - len(prologue)
+        self.prologue = deque(prologue)
+        self.resendFrom = -1
+        self.replayFrom = self.replayEnd = 0
+        self.incident = None
+        self.resendLog = []
+        self.sentLines = History()
+        self.held = None
+        self.queueindex = first
+        with self.flow:     # lines of an aborted print are never acknowledged
+            self.pending = 0
+            self.inFlight.clear()
+            self.bytesInFlight = 0
+        self.charCounting = data.flowControl == 'chars'
+        self.underruns.reset(self.job, first)
+        if self.metrics:
+            self.metrics.reset()
+
     def abort_print(self):
         print("Entering abort_print")
         self.printing = False
+        self._wake()    # release the print thread if it waits for buffers
         if self.print_thread:
             self.print_thread.join()
         self.print_thread = None
-        self.gcode = []
+        self._closeJob()
+
+    def _closeJob(self):
+        if self.job:
+            self.job.close()
+            self.job = None
 
     def print(self):
         ''' This is the print xmitter thread. It calls sendNext() repeatedly
@@ -132,6 +338,7 @@ class Transport():
         print("Starting print thread")
         self.stop_xmtr = True   # kill xmtr thread first
         if self.xmtr:
+            self._wake()
             self.xmtr.join()    # wait until xmtr is dead
         self.xmtr = None
         self.CRCflag = False
@@ -145,32 +352,91 @@ class Transport():
     def _checksum(self, command):
         return reduce(lambda x, y: x ^ y, map(ord, command))
 
-    def _send(self, command, lineno = 0, calcCRC = False):
+    def _wake(self):
+        ''' Wake up all threads waiting on the flow condition, e.g. 
+            because a killer flag has been set.
+        '''
+        with self.flow:
+            self.flow.notify_all()
+        data.xmtQ.put(None)     # sender may be blocked on the queue
+
+    def _send(self, command, lineno = 0, calcCRC = False, cancelled = None):
+        ''' Frame the command (see _frame) and transmit it to the printer.'''
+        return self._write(self._frame(command, lineno, calcCRC),
+                           lineno, cancelled)
+
+    def _frame(self, command, lineno = 0, calcCRC = False):
         ''' If specified by calcCRC wraps command in linenum and
             checksum. If command is not M110 (set linenumber) and
             it is wrapped then save a copy in sentLines so it can
             be retrieved when a resend request occurs.
-            Then, wrapped or not, transmit the command to the printer.
+            Returns the frame, wrapped or not, ready to be written.
         '''
         if calcCRC:
             prefix = "N" + str(lineno) + " " + command
             command = prefix + "*" + str(self._checksum(prefix))
-            if not "M110" in command:
-                self.sentLines[lineno] = command
-        if self.buffAvailable <= self.pending:
-            return False  # no buffers free; call again later
+        frame = (command + "\n").encode('ascii', 'replace')
+        if calcCRC and not "M110" in command:
+            self.sentLines.put(lineno, frame)
+        return frame
+
+    def _canSend(self, size):
+        ''' Flow control: True if a frame of size bytes may be sent now.
+            In ok-counting mode a free input buffer (B-word) is required
+            for each line. In char-counting mode lines may also queue up
+            in Marlin's RX buffer: the oldest cmdSlots lines in flight
+            sit in the command queue, the bytes of all younger ones must
+            fit in the RX buffer. The number of lines in flight is also
+            kept below the free input plus planner buffers (B- and 
+            P-word). Call with flow held.
+        '''
+        if not self.charCounting:
+            return self.buffAvailable > self.pending
+        if len(self.inFlight) < self.cmdSlots:
+            return True
+        queued = sum(islice(self.inFlight, self.cmdSlots))
+        return self.bytesInFlight - queued + size <= self.BUFSIZE \
+               and self.pending < self.buffAvailable + self.P_word
+
+    def _write(self, frame, lineno = 0, cancelled = None):
+        ''' Block until Marlin has room for the frame (signalled by the 
+            listen thread) and transmit the ready-made frame (bytes,
+            including the newline). Returns False without transmitting 
+            if cancelled() becomes True while waiting.
+        '''
+        if cancelled is None:
+            cancelled = lambda: not self.printing
+        size = len(frame)
+        with self.flow:
+            self.flow.wait_for(lambda: self._canSend(size) or cancelled())
+            if cancelled():
+                return False    # aborted while waiting for buffers
+            self._commit(size, lineno)
+        return self._transmit(frame)
+
+    def _commit(self, size, lineno):
+        ''' Account for a frame about to be sent. Call with flow held.'''
+        self.pending += 1
+        self.lastLineSent = lineno
+        self.inFlight.append(size)
+        self.bytesInFlight += size
+        if self.metrics:
+            self.metrics.sent(lineno, size)
+
+    def _transmit(self, frame):
+        ''' Write frame (one or more frames while printing) to the printer.'''
 #========================================================================
 #        #resend test:
-#        if not self.CRCflag and command.startswith("N10"):
-#            command = "N10 GARBAGE*00" # bad command to trigger resend
+#        if not self.CRCflag and frame.startswith(b"N10 "):
+#            frame = b"N10 GARBAGE*00\n" # bad command to trigger resend
 #            self.CRCflag = True
 #========================================================================
-        self.pending += 1
-        self.lastLineSent = lineno
 #        print("Resending: {}; pending: {}; lastLine: {}; lastAck: {}; bufAvail: {}; P-word: {}".format( \
-#            self.resending, self.pending, self.lastLineSent, self.lastLineAck, self.buffAvailable, self.P_word))
+#            self.incident, self.pending, self.lastLineSent, self.lastLineAck, self.buffAvailable, self.P_word))
+        if self.metrics:
+            self.metrics.count('writes')
         try:
-            self.printer.write((command + "\n").encode('ascii'))
+            self.printer.write(frame)
         except SerialException:
             self.status.show("*** Error: Can't write to printer")
             self.printing = False # abort printing
@@ -184,75 +450,164 @@ class Transport():
         '''
         print("Starting transmitter thread")
         while not self.stop_xmtr:
-            while data.xmtQ.empty():
-                time.sleep(0.001)
-                if self.stop_xmtr:
-                    break
-            else:
-                command = data.xmtQ.get(True, 0.1)
-                while not self._send(command) and not self.stop_xmtr:
-                    time.sleep(0.001)
+            command = data.xmtQ.get()   # blocks until there is something to do
+            if command is None:     # wake up call; check killer flag
+                continue
+            self._send(command, cancelled = lambda: self.stop_xmtr)
         print("Transmitter thread killed")
         
     def sendNext(self):
-        ''' The workhorse for sending gcode data to the printer. It checks,
-            in that order, either:
-              - if we are still printing. If not, e.g. due to an abort,
-                we return immediately. Also all waiting  loops check this.
-              - if there is a resend request pending: if so it takes the
-                next command from the history in the dictionary sentLines
+        ''' The workhorse for sending gcode data to the printer. It takes
+            the next frame from _nextFrame() and, as soon as Marlin has
+            room for it, transmits it together with all the frames after
+            it that Marlin has room for as well, in a single write (see
+            _batch). When the whole job has been sent it waits until
+            Marlin has acknowledged the last lines, because it might
+            still ask for a resend, and then ends the print.
+        '''
+        if not self.printer or not self.printing:
+            return
+        item = self._takeFrame()
+        if item:
+            size = len(item[0])
+            with self.flow:     # waits for space in Marlin's buffers:
+                self.flow.wait_for(lambda: self._canSend(size) or not self.printing)
+                if not self.printing:
+                    return
+                frames = self._batch(item)
+            self._transmit(frames)
+        elif item is None:  # all sent
+            with self.flow:
+                self.flow.wait_for(lambda: self._drained(), 5.0)
+                done = self.printing and self.resendFrom == -1
+            if done:    # not aborted while draining
+                self._complete()
+
+    def _nextFrame(self):
+        ''' Decide what to send next while printing. It checks, in that
+            order, either:
+              - if there is a resend request pending: if so it sets up
+                the replay of the whole window from the line requested
+                up to linenum. The frames are taken from the history in
+                the ring buffer sentLines, one per call, until the window
+                is done or a new request supersedes it.
               - if there is an entry in the priority queue (prioQ) it
                 transmits that entry in front of any other command. 
                 Currently not used.
-              - otherwise it sends the next command from the gcode array
-                in the main queue (gcode) and it appends the sent command
-                to the sendLines dict.
-                
+              - otherwise it takes the next frame of the compiled job 
+                (already numbered and checksummed) and it stores the 
+                frame in the sentLines history.
+            Returns a tuple (frame, lineno, kind) to be passed on to
+            _write() and, once written, kind to _sent(). Returns None
+            when the job has been sent completely and False when the 
+            print has been aborted.
         '''
-        if not self.printer or not self.printing:
-            return
+        with self.flow:
+            if self.resendFrom != -1:
+                if self.resendFrom < self.linenum:  # start a new window
+                    self.replayFrom, self.replayEnd = self.resendFrom, self.linenum
+                    if self.incident:
+                        self.incident['stale'] = self.replayEnd - self.replayFrom - 1
+                        self.incident['end'] = self.replayEnd
+                self.resendFrom = -1
 
-        if self.resendFrom != -1 and self.resendFrom < self.linenum:
-            self.resending = True   # tell listen thread to ignore subsequent resends
-#            print("linenum: {}; resendFrom: {}".format(self.linenum, self.resendFrom))
+        if self.replayFrom < self.replayEnd:
             # we don't add linenum and CRC because line already has them
-            while not self._send(self.sentLines[self.resendFrom], self.resendFrom, False):
-                if not self.printing: # aborted..
-                    return
-                time.sleep(0.0005)
-            self.resendFrom += 1    # resend all lines until linenum catches up
-            return
+            frame = self.sentLines.get(self.replayFrom)
+            if frame is None:   # Marlin wants a line we no longer have
+                first, last = self.sentLines.window()
+                self.status.show("*** Error: resend of line {} requested, "
+                                 "history holds lines {}..{}; print aborted\n"
+                                 .format(self.replayFrom, first, last))
+                self.printing = False
+                return False
+            return frame, self.replayFrom, 'resend'
 
-        self.resendFrom = -1
-        self.resending = False
-        
         if not self.prioQ.empty():
-            while not self._send(self.prioQ.get_nowait()):
-                if not self.printing:
-                    return
-                time.sleep(0.0005)
+            command = self.prioQ.get_nowait()
             self.prioQ.task_done()
-            return
+            return (command + "\n").encode('ascii', 'replace'), 0, 'prio'
+
+        if self.prologue:
+            self.sentLines.reserve(self.pending + 1)
+            return self._frame(self.prologue[0], self.linenum, True), self.linenum, 'prologue'
 
         if self.queueindex < self.maxIndex:
-            gline = self.gcode[self.queueindex]
+            frame = self.job.frame(self.queueindex)
+            self.sentLines.reserve(self.pending + 1)
+            self.sentLines.put(self.linenum, frame)
+            return frame, self.linenum, 'job'
+        return None
+
+    def _takeFrame(self):
+        ''' The item held back by _batch(), else the next from _nextFrame().'''
+        item, self.held = self.held, None
+        return item or self._nextFrame()
+
+    def _batch(self, item):
+        ''' Commit the frame of item, for which Marlin has room, and all
+            the frames following it as long as flow control allows each
+            and they fit into txBuf. The frames are copied into txBuf, so
+            the lot goes out in one write; each is committed, kept in
+            sentLines and numbered exactly as if written on its own.
+            Returns the bytes to write. Call with flow held.
+        '''
+        buf, end = self.txBuf, 0
+        while True:
+            frame, lineno, kind = item
+            size = len(frame)
+            self._commit(size, lineno)
+            self._sent(kind)
+            if not self.coalesce or not end and size > len(buf):
+                return frame    # written on its own
+            buf[end:end + size] = frame
+            end += size
+            item = self._nextFrame()
+            if not item or not self.printing:
+                break
+            size = len(item[0])
+            if end + size > len(buf) or not self._canSend(size):
+                if item[2] == 'prio':   # taken off prioQ: send it next time
+                    self.held = item
+                break
+        return self.txView[:end]
+
+    def _sent(self, kind):
+        ''' Advance past the frame _nextFrame() returned once it has
+            been written.
+        '''
+        if kind == 'resend':
+            self.replayFrom += 1
+            if self.incident:
+                self.incident['lines'] += 1
+            if self.metrics:
+                self.metrics.count('replayed')
+        elif kind == 'job':
             self.queueindex += 1
-            # remove empty lines and comments:
-            gline = gline[:gline.find(';')]
-            if gline:
-                while not self._send(gline, self.linenum, True):
-                    # wait for space in Marlin's buffers
-                    if not self.printing:
-                        return  # avoid hang-up when aborted
-                    time.sleep(0.0005)
-                self.linenum += 1
-        else:
-            self.printing = False   # we're done (or aborted)...
-            self.status.show( "\nPrinting Completed")
-            self.print_thread = None
-            self.linenum = 0
-            self.queueindex = 0
-        
+            self.linenum += 1
+        elif kind == 'prologue':
+            self.prologue.popleft()
+            self.linenum += 1
+
+    def _drained(self):
+        ''' True when Marlin has acknowledged all lines sent, a resend
+            has been requested or the print has been aborted. Call with
+            flow held.
+        '''
+        return not self.pending or not self.printing or self.resendFrom != -1
+
+    def _complete(self):
+        ''' The job has been printed: reset the print state.'''
+        self.printing = False   # we're done (or aborted)...
+        self.status.show( "\nPrinting Completed")
+        if self.metrics:
+            self.status.show("\n" + self.metrics.report())
+        if self.underruns.events:
+            self.status.show("\n" + self.underruns.report())
+        self.print_thread = None
+        self.linenum = 0
+        self.queueindex = 0
+
     def connect(self, status=None):
         ''' The method to open the connection to the Marlin printer via
             the serial port. If the port could be opened successfully
@@ -260,6 +615,18 @@ class Transport():
             thread in order to be able to access the printer.
             This method is normally invoked from the Gui Connect button.
         '''
+        if not self._open(status):
+            return False   # error!
+        self.rcvr = threading.Thread(target = self.listen)
+        self.xmtr = threading.Thread(target = self.sender)
+        self.stop_xmtr = False
+        self.stop_rcvr = False
+        self.rcvr.start()
+        self.xmtr.start()
+        return True
+
+    def _open(self, status):
+        ''' Open the serial port and reset the printer.'''
         try:
             self.printer = Serial(port = data.port,
                               baudrate = data.baud,
@@ -268,8 +635,11 @@ class Transport():
             if not self.printer.isOpen():
                 self.printer.open()
             self.printer.flush()
-            self.printer.setDTR(1)  # hardware resets the machine
-            self.printer.setDTR(0)
+            try:
+                self.printer.setDTR(1)  # hardware resets the machine
+                self.printer.setDTR(0)
+            except OSError:     # no modem lines, e.g. a pseudo-terminal
+                pass
             data.connected = True
             status.show("printer is on-line\n")
 
@@ -277,12 +647,6 @@ class Transport():
             print("Could not connect to {} at baudrate {}:" \
                   .format(data.port, data.baud), e)
             return False   # error!
-        self.rcvr = threading.Thread(target = self.listen)
-        self.xmtr = threading.Thread(target = self.sender)
-        self.stop_xmtr = False
-        self.stop_rcvr = False
-        self.rcvr.start()
-        self.xmtr.start()
         return True
 
     def disconnect(self, status=None):
@@ -297,17 +661,22 @@ class Transport():
         data.stop_decoder()
         if self.xmtr:
             self.stop_xmtr = True
+            self._wake()
             self.xmtr.join()
             self.xmtr = None
         if self.print_thread:
-            self.stop_print_thread = True
+            self.printing = False
+            self._wake()
             self.print_thread.join()
             self.print_thread = None
+        self._close(status)
+
+    def _close(self, status):
+        ''' Close the serial port and clear status vars.'''
         if self.printer.isOpen():
             self.printer.close()
             self.printer = None
-        data.ready = False     # reset transprt state
+        data.state.reset()     # not ready, nothing homed
         data.connected = False
-        data.homed = set()     # unhome all axes (needed??)
         status.show("printer off-line\n")
        
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module contains the planner underrun detector for the 3D-Gui program.
+
+The P word of Marlin's ADVANCED_OK reply is the number of free slots in
+the planner. When it reaches its maximum in the middle of a print the
+planner has run empty: the printhead stops until the next move arrives,
+which shows as a stutter or a blob on the part. Typical causes are long
+runs of tiny segments (sliced arcs, high resolution curves) that Marlin
+executes faster than the host can feed them.
+
+The detector watches every ok while a job is being sent. An underrun is
+recorded when the planner runs empty after having held moves, unless it
+is expected: a resend is being recovered, the line just executed is not
+a move (M109, G4, G28 ..), or the whole job has been sent already. Each
+event keeps the source lines between the one last acknowledged and the
+one last sent; report() merges nearby events into hotspot line ranges.
+"""
+import bisect
+import re
+import time
+
+moveExp = re.compile(rb'N-?\d+ G[0-3]\b')
+
+
+class UnderrunDetector():
+    ''' Collects the planner underruns of one job.'''
+
+    def __init__(self):
+        self.reset(None)
+
+    def reset(self, job, first=0):
+        ''' Start over for compiled job job, printed from frame first.'''
+        self.job = job
+        self.first = first      # lines before are not job frames (resume)
+        self.start = time.perf_counter()
+        self.plannerSize = 0    # largest P seen: all slots free
+        self.armed = False      # planner has held moves since last event
+        self.events = []        # (seconds, first, last source line in flight)
+
+    def check(self, P, acked, sent):
+        ''' Called for each "ok N<acked> P<P>" during a print; sent is the
+            line number last sent. Returns True for an underrun. Call
+            with the transport's flow lock held.
+        '''
+        if P > self.plannerSize:
+            self.plannerSize = P
+        if P < self.plannerSize:
+            self.armed = True
+            return False
+        if not self.armed or not self.job:
+            return False
+        self.armed = False
+        if not self.first <= acked < len(self.job) or sent >= len(self.job) - 1:
+            return False    # start up, or the end of the job
+        if not moveExp.match(self.job.frame(acked)):
+            return False    # the planner drains before and during commands
+        self.events.append((time.perf_counter() - self.start,
+                            self.job.srcLine[acked],
+                            self.job.srcLine[min(max(sent, acked), len(self.job) - 1)]))
+        return True
+
+    def hotspots(self, gap=50):
+        ''' Merge events whose source line ranges are less than gap lines
+            apart. Returns (first line, last line, events) tuples, most
+            events first. Line numbers count from 1 as in an editor.
+        '''
+        spots = []
+        for t, first, last in sorted(self.events, key=lambda e: e[1]):
+            if spots and first <= spots[-1][1] + gap:
+                spots[-1][1] = max(spots[-1][1], last)
+                spots[-1][2] += 1
+            else:
+                spots.append([first, last, 1])
+        spots.sort(key=lambda s: -s[2])
+        return [(first + 1, last + 1, n) for first, last, n in spots]
+
+    def report(self, top=10):
+        ''' Text summary for a text panel. The command sent for the first
+            line of each hotspot is quoted from the compiled job, which
+            unlike the gcode file is memory mapped even for compressed
+            files.
+        '''
+        if not self.events:
+            return 'planner never ran empty\n'
+        lines = ['planner ran empty {} times, hotspots:\n'.format(len(self.events))]
+        for first, last, n in self.hotspots()[:top]:
+            text = ''
+            if self.job:
+                text = '  ' + self._command(first - 1)[:40]
+            lines.append('  lines {}-{}: {}x{}\n'.format(first, last, n, text))
+        return ''.join(lines)
+
+    def _command(self, line):
+        ''' The command of the compiled job sent for source line line.'''
+        index = bisect.bisect_left(self.job.srcLine, line)
+        if index >= len(self.job):
+            return ''
+        frame = self.job.frame(index)
+        return frame.split(b' ', 1)[-1].rsplit(b'*', 1)[0].decode('ascii', 'replace')